@@ -1,14 +1,36 @@
-import os
-from . import authenticate
+"""
+Download and modify DCM reports through the DCM/DFA Reporting API.
 
+Nothing is authenticated or imported from googleapiclient until it is first
+used: the names below are loaded from api.api on first access, and the OAuth
+flow runs the first time a service is built without stored credentials.
+"""
 
-credentials = os.path.join(os.path.split(authenticate.__file__)[0], 'credentials.json')
+import importlib
 
-if not os.path.isfile(credentials):
-    path, _ = os.path.split(__file__)
-    secret_path = os.path.join(path, 'client_secret.json')
-    scope = 'https://www.googleapis.com/auth/dfareporting'
 
-    authenticate.run(scope, secret_path)
+_exports = ['Profile', 'Report', 'run_and_download_report', 'run_and_download_reports',
+            'get_profiles', 'get_profile_ids', 'invalidate_profile_cache',
+            'create_service', 'clear_services', 'set_service_factory', 'set_file_index',
+            'is_valid_user']
 
-from .api import Profile, Report, run_and_download_report, get_profiles, create_service, is_valid_user
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module('.api', __name__), name)
+    else:
+        try:
+            value = importlib.import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+            raise AttributeError(f"module '{__name__}' has no attribute '{name}'") from None
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
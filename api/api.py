@@ -5,22 +5,69 @@ Module for downloading reports via the DCM API.
 """
 
 
+import copy
+import gzip
 import json
 import os
+import random
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document, DISCOVERY_URI
+from cachetools import TTLCache
 import httplib2
 from oauth2client.file import Storage
 from googleapiclient import errors
+from googleapiclient.http import HttpRequest
 from contextlib import contextmanager
 
+import instrumentation
+
+from .dimensions import resolve as resolve_dimensions
+from .file_index import get_file_index, set_file_index
+
+
+scope = 'https://www.googleapis.com/auth/dfareporting'
+
+discovery_path = os.path.join(os.path.split(__file__)[0], 'discovery')
+
+# Services are shared by every APIResource in the process. httplib2.Http is not
+# thread-safe, so each thread gets its own service built from the same
+# credentials and discovery document. They are kept in thread-local storage so
+# they are released with their thread, and dropped by clear_services by
+# moving to a new generation.
+_services = threading.local()
+_services_generation = 0
+_credentials = {}
+_services_lock = threading.Lock()
+
+# Called with (api_name, version, credentials) to build each thread's service,
+# see set_service_factory
+_service_factory = None
+
+download_chunk_size = 10 * 1024 ** 2
+
+# Retried requests wait retry_interval seconds, doubling up to max_retry_interval
+retry_interval = 1
+max_retry_interval = 32
+
+# Reasons given with 403 errors that clear up after waiting
+rate_limit_reasons = frozenset(['rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'])
+
+# User profiles rarely change, so they are only listed again once the TTL
+# expires. The cache is rebuilt whenever profile_cache_ttl is changed.
+profile_cache_ttl = 15 * 60
+_profile_cache = None
+_profile_cache_lock = threading.RLock()
+
 
 class APIResource(object):
 
-    def __init__(self, resource_type, **params):
+    def __init__(self, resource_type, service=None, **params):
         self.resource_type = resource_type
-        self._service = create_service()
+        self._service = service or create_service()
         self.params = params
         self.body = self.get(**params)
 
@@ -38,12 +85,12 @@ class APIResource(object):
 
 class Profile(APIResource):
 
-    def __init__(self, profileId):
+    def __init__(self, profileId, service=None):
 
         if not is_valid_user(profileId):
             raise ValueError(f'Invalid user profile id: {profileId}')
 
-        super().__init__("userProfiles", profileId=profileId)
+        super().__init__("userProfiles", service=service, profileId=profileId)
         self.profileId = str(profileId)
 
         self.username = self.body.get('userName')
@@ -65,12 +112,15 @@ class Profile(APIResource):
 
 class Report(APIResource):
 
-    def __init__(self, profileId, reportId):
-        super().__init__('reports', reportId=reportId, profileId=profileId)
+    def __init__(self, profileId, reportId, service=None):
+        super().__init__('reports', service=service, reportId=reportId, profileId=profileId)
 
         self.reportId = str(reportId)
         self.profileId = str(profileId)
 
+        # Body changes staged by batch_update, waiting to be sent
+        self._staged_body = None
+
         # Pull in report attributes
 
     @property
@@ -93,37 +143,195 @@ class Report(APIResource):
     def refresh_body(self):
         self.body = self.get_report_body()
 
+    def iter_files(self, page_size=None):
+        '''
+        Yield the files of this report, most recently modified first, fetching
+        further pages only as they are needed
+        '''
+        params = {'profileId': self.profileId,
+                  'reportId': self.reportId,
+                  'sortField': 'LAST_MODIFIED_TIME',
+                  'sortOrder': 'DESCENDING'}
+
+        if page_size is not None:
+            params['maxResults'] = page_size
+
+        while True:
+            response = self._service.reports().files().list(**params).execute()
+
+            for file in response.get('items', []):
+                yield file
+
+            page_token = response.get('nextPageToken')
+            if not page_token or not response.get('items'):
+                break
+
+            params['pageToken'] = page_token
+
+    def sync_file_index(self):
+        '''
+        Add files that are new or changed since the last sync to the local file
+        index. Stops paging at the first file the index already knows about, so
+        an up to date index costs a single request.
+        '''
+        index = get_file_index()
+        new_files = []
+
+        for file in self.iter_files():
+            known = index.get(self.reportId, file['id'])
+
+            if known is not None and (known['lastModifiedTime'], known.get('status')) == (file['lastModifiedTime'], file.get('status')):
+                break
+
+            new_files.append(file)
+
+        index.upsert(new_files)
+
+        return new_files
+
     def get_available_files(self, get_all=True):
-        '''Get a list of all files associated with a report id'''
-        request = self._service.files().list(profileId=self.profileId)
-        response = request.execute()['items']
+        '''
+        Get a list of all files associated with a report id, oldest first.
+        With get_all=False, only new pages are requested and the rest comes
+        from the local file index.
+        '''
+        if get_all:
+            files = list(self.iter_files())
+            get_file_index().upsert(files)
 
-        files = response
+        else:
+            self.sync_file_index()
+            files = get_file_index().files(self.reportId)
 
         return sorted(files, key=lambda f: int(f['lastModifiedTime']))
 
-    def download_file(self, file_id, path):
-
+    @instrumentation.traced('Report.download_file')
+    def download_file(self, file_id, path, chunk_size=None, progress=None,
+                      compress=False, num_retries=3):
+        '''
+        Stream a report file to path in chunks, so memory use does not depend
+        on the size of the report.
+
+        Args:
+        chunk_size (default download_chunk_size) - bytes requested at a time
+        progress - called with (bytes_downloaded, total_bytes) after each chunk
+        compress (default False) - write gzip-compressed output
+        num_retries (default 3) - retries per chunk on connection or server errors
+
+        The raw bytes are written to path + '.<file_id>.part', and compressed
+        or renamed once complete. An interrupted download resumes from the
+        partial file of the same report file, never from another file's, in
+        either mode.
+        '''
+        chunk_size = chunk_size or download_chunk_size
         request = self._service.files().get_media(reportId=self.reportId, fileId=file_id)
-        response = request.execute()
 
-        if self.format == "CSV":
+        partial = f'{path}.{file_id}.part'
+        offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+
+        with open(partial, 'ab') as f:
+            total = None
+
+            while total is None or offset < total:
+                headers = dict(request.headers)
+                headers['range'] = f'bytes={offset}-{offset + chunk_size - 1}'
+
+                resp, content = request_with_retries(request.http, request.uri, headers, num_retries)
 
-            with open(path, 'w') as f:
-                f.write(response.decode())
+                if resp.status == 416:
+                    # The partial file already holds the whole report
+                    break
 
-        if self.format == "EXCEL":
+                if resp.status == 200:
+                    # Range not honoured, the whole file was sent
+                    if offset:
+                        f.seek(0)
+                        f.truncate()
+                    offset = 0
 
-            with open(path, 'wb') as f:
-                f.write(response)
+                elif resp.status != 206:
+                    raise errors.HttpError(resp, content, uri=request.uri)
+
+                f.write(content)
+                offset += len(content)
+                instrumentation.count('bytes_downloaded', len(content))
+
+                _, _, length = resp.get('content-range', '').rpartition('/')
+                if resp.status == 200:
+                    total = offset
+                elif length.isdigit():
+                    total = int(length)
+                elif len(content) < chunk_size:
+                    total = offset
+
+                if progress is not None:
+                    progress(offset, total)
+
+                if not content:
+                    break
+
+        if compress:
+            compressed = f'{path}.{file_id}.gz.part'
+            with open(partial, 'rb') as src, gzip.open(compressed, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(compressed, path)
+            os.remove(partial)
+        else:
+            os.replace(partial, path)
+
+    def get_file(self, file_id, num_retries=0):
+        '''
+        Get the file resource for a report file, including its status. Rate
+        limit and server errors are retried num_retries times.
+        '''
+        request = self._service.reports().files().get(profileId=self.profileId,
+                                                      reportId=self.reportId,
+                                                      fileId=file_id)
+        return execute_with_retries(request, num_retries)
+
+    def wait_for_file(self, file_id, check_interval=10, max_interval=300,
+                      backoff=2, jitter=0.1, timeout=None, num_retries=3):
+        '''
+        Poll the status of a report file until it is available. Returns the
+        file resource.
+
+        Args:
+        check_interval (default 10) - seconds before the second status check
+        max_interval (default 300) - longest wait between two checks
+        backoff (default 2) - factor applied to the interval after each check
+        jitter (default 0.1) - random +/- fraction applied to every interval
+        timeout (default None) - raise TimeoutError after this many seconds
+        num_retries (default 3) - retries per status check on rate limit or server errors
+        '''
+        start = time.time()
+
+        for interval in backoff_intervals(check_interval, max_interval, backoff, jitter):
+            file = self.get_file(file_id, num_retries=num_retries)
+            status = file.get('status')
+
+            if status == 'REPORT_AVAILABLE':
+                return file
+
+            if status in ('FAILED', 'CANCELLED'):
+                raise RuntimeError(f"Report '{self.name}' file {file_id} finished with status {status}")
+
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise TimeoutError(f"Report '{self.name}' file {file_id} not available after {timeout}s")
+                interval = min(interval, remaining)
+
+            print(f"Report '{self.name}' hasn't finished running. Checking again in {interval:.0f}s...")
+            time.sleep(interval)
 
     def download_latest_file(self, filename):
-        files = self.get_available_files()
+        self.sync_file_index()
+
+        latest = get_file_index().latest(self.reportId)
 
-        if len(files) == 0:
+        if latest is None:
             raise ValueError("No files available for download with this report")
 
-        latest = sorted(files, key=lambda f: f['lastModifiedTime'], reverse=True)[0]
         return self.download_file(latest['id'], filename)
 
     def run(self):
@@ -136,18 +344,56 @@ class Report(APIResource):
 
     @contextmanager
     def update_request_body(self):
-        try:
-            body = self.body.copy()
-            yield body
+        '''
+        Yield a copy of the report body to modify. The changes are sent when the
+        block exits, unless a batch_update is in progress, in which case they are
+        sent with the rest of the batch.
+        '''
+        if self._staged_body is not None:
+            yield self._staged_body
+            return
+
+        body = copy.deepcopy(self.body)
+        yield body
 
+        self.commit_body(body)
+
+    @contextmanager
+    def batch_update(self):
+        '''
+        Stage any number of changes and send them in a single update:
+
+        >>> with report.batch_update():
+        ...     report.set_format("CSV")
+        ...     report.set_filename("weekly_report")
+        ...     report.set_dimensions(["Placement", "Date"])
+        '''
+        if self._staged_body is not None:
+            # Nested batches are part of the outer one
+            yield self._staged_body
+            return
+
+        self._staged_body = copy.deepcopy(self.body)
+        try:
+            yield self._staged_body
+            body = self._staged_body
         finally:
+            self._staged_body = None
+
+        self.commit_body(body)
+
+    def commit_body(self, body):
+        '''Send body as the new report body, skipping the request if nothing changed'''
 
-            req = self._service.reports().update(reportId=self.reportId,
-                                                 profileId=self.profileId,
-                                                 body=body)
-            new_body = req.execute()
+        if body == self.body:
+            return
 
-            self.body = new_body
+        req = self._service.reports().update(reportId=self.reportId,
+                                             profileId=self.profileId,
+                                             body=body)
+        new_body = req.execute()
+
+        self.body = new_body
 
     def set_date_range(self, start=None, end=None, *, period=None):
 
@@ -185,16 +431,13 @@ class Report(APIResource):
 
     def set_dimensions(self, dimensions):
 
-        path = os.path.join(os.path.split(__file__)[0], "standard_dimensions.json")
-
-        with open(path, "r") as f:
-            standard_dimensions = json.load(f)
+        api_names = resolve_dimensions(dimensions)
 
         with self.update_request_body() as body:
             body['criteria']['dimensions'] = []
-            for dimension in dimensions:
+            for api_name in api_names:
                 entry = {'kind': 'dfareporting#sortedDimension',
-                         'name': standard_dimensions[dimension.lower()]["API Name"]}
+                         'name': api_name}
 
                 body['criteria']['dimensions'].append(entry)
 
@@ -202,50 +445,265 @@ class Report(APIResource):
         return f"Report(name='{self.name}', id='{self.reportId}', profileId='{self.profileId}')"
 
 
+def backoff_intervals(initial, maximum=None, factor=2, jitter=0):
+    '''
+    Yield an endless sequence of wait times, starting at initial and multiplied
+    by factor each time, capped at maximum, with +/- jitter applied to each
+    '''
+    interval = initial
+
+    while True:
+        yield interval * (1 + random.uniform(-jitter, jitter))
+
+        interval *= factor
+        if maximum is not None:
+            interval = min(interval, maximum)
+
+
+def is_transient_error(status, content):
+    '''Whether a response with this status and error content is worth retrying'''
+
+    if status == 429 or status >= 500:
+        return True
+
+    if status == 403:
+        try:
+            reasons = {error.get('reason') for error in json.loads(content)['error']['errors']}
+        except (ValueError, KeyError, TypeError):
+            return False
+
+        return bool(reasons & rate_limit_reasons)
+
+    return False
+
+
+def request_with_retries(http, uri, headers=None, num_retries=3):
+    '''
+    Send a GET request, retrying with exponential backoff on connection errors,
+    rate limiting and server errors
+    '''
+    intervals = backoff_intervals(retry_interval, maximum=max_retry_interval, factor=2, jitter=0.1)
+
+    for attempt in range(num_retries + 1):
+        try:
+            instrumentation.count('api_calls')
+            resp, content = http.request(uri, headers=headers)
+        except (OSError, httplib2.HttpLib2Error):
+            if attempt == num_retries:
+                raise
+        else:
+            if not is_transient_error(resp.status, content) or attempt == num_retries:
+                return resp, content
+
+        time.sleep(next(intervals))
+
+
+def execute_with_retries(request, num_retries=3):
+    '''Execute an API request with the same retry policy as request_with_retries'''
+
+    intervals = backoff_intervals(retry_interval, maximum=max_retry_interval, factor=2, jitter=0.1)
+
+    for attempt in range(num_retries + 1):
+        try:
+            return request.execute()
+        except errors.HttpError as e:
+            if not is_transient_error(e.resp.status, e.content) or attempt == num_retries:
+                raise
+        except (OSError, httplib2.HttpLib2Error):
+            if attempt == num_retries:
+                raise
+
+        time.sleep(next(intervals))
+
+
+def get_credentials(credentials='credentials.json'):
+    '''Load the stored OAuth credentials once per process'''
+
+    with _services_lock:
+        if credentials not in _credentials:
+            path, _ = os.path.split(__file__)
+            storage = Storage(os.path.join(path, credentials))
+            stored = storage.get()
+
+            if stored is None and credentials == 'credentials.json' and os.path.isfile(os.path.join(path, 'client_secret.json')):
+                # First use without stored credentials, ask for authorization
+                from . import authenticate
+                authenticate.run(scope, os.path.join(path, 'client_secret.json'), argv=[])
+                stored = storage.get()
+
+            if stored is None or stored.invalid:
+                errormessage = f'Missing or invalid credentials at {path}. Run authenticate.py to regenerate'
+                raise ValueError(errormessage)
+
+            _credentials[credentials] = stored
+
+        return _credentials[credentials]
+
+
+def get_discovery_document(api_name, version, http):
+    '''
+    Return the discovery document for an API, fetching it only the first time
+    and keeping a copy in the discovery folder afterwards
+    '''
+    path = os.path.join(discovery_path, f'{api_name}.{version}.json')
+
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    uri = DISCOVERY_URI.format(api=api_name, apiVersion=version)
+    resp, content = http.request(uri)
+
+    if resp.status >= 400:
+        raise errors.HttpError(resp, content, uri=uri)
+
+    if isinstance(content, bytes):
+        content = content.decode()
+
+    os.makedirs(discovery_path, exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+    return content
+
+
+class InstrumentedHttpRequest(HttpRequest):
+    '''HttpRequest counting every API call for instrumentation'''
+
+    def execute(self, *args, **kwargs):
+        instrumentation.count('api_calls')
+        return super().execute(*args, **kwargs)
+
+
+def build_service(api_name='dfareporting', version='v2.8',
+                  credentials='credentials.json'):
+    '''Build a new service object, bypassing the shared registry'''
+
+    http = get_credentials(credentials).authorize(httplib2.Http())
+    document = get_discovery_document(api_name, version, http)
+
+    return build_from_document(document, http=http, requestBuilder=InstrumentedHttpRequest)
+
+
 def create_service(api_name='dfareporting', version='v2.8',
-                   credentials='credentials.json'):
+                   credentials='credentials.json', refresh=False):
     '''
     Args:
     api_name (default 'dfareporting')
     version (default 'v2.8')
     credentials (default 'credentials.dat')
+    refresh (default False) - build a new service instead of reusing the
+    one already created for this thread
     The list of APIs can be found: https://developers.google.com/api-client-library/python/apis/
     '''
-    path, _ = os.path.split(__file__)
-    storage = Storage(os.path.join(path, credentials))
-    credentials = storage.get()
+    key = (api_name, version, credentials)
+    services = _thread_services()
 
-    if credentials is None or credentials.invalid:
-        errormessage = f'Missing or invalid credentials at {path}. Run authenticate.py to regenerate'
-        raise ValueError(errormessage)
+    service = services.get(key)
 
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-    service = build(api_name, version, http=http)
+    if service is None or refresh:
+        service = (_service_factory or build_service)(api_name, version, credentials)
+        services[key] = service
 
     return service
 
 
+def _thread_services():
+    '''The services built on this thread since the last clear_services'''
+
+    if getattr(_services, 'generation', None) != _services_generation:
+        _services.generation = _services_generation
+        _services.services = {}
+
+    return _services.services
+
+
+def clear_services():
+    '''Forget all shared services and credentials, e.g. after re-authenticating'''
+
+    global _services_generation
+
+    with _services_lock:
+        _services_generation += 1
+        _credentials.clear()
+
+
+def set_service_factory(factory=None):
+    '''
+    Build services with factory(api_name, version, credentials) instead of
+    build_service, e.g. to run against api.fake.FakeDCM. None restores
+    build_service. Shared services and cached profiles are dropped either way.
+    '''
+    global _service_factory
+
+    _service_factory = factory
+
+    clear_services()
+    invalidate_profile_cache()
+
+
 def is_valid_user(profileId):
-    profileId = str(profileId)
+    return str(profileId) in get_profile_ids()
 
-    if profileId in [x['profileId'] for x in get_profiles()]:
-        return True
 
-    return False
+def get_profiles(refresh=False):
+    '''
+    List the user profiles available to the stored credentials. The result is
+    cached for profile_cache_ttl seconds, unless refresh is True.
+    '''
+    return _get_cached_profiles(refresh)['items']
 
 
-def get_profiles():
-    service = create_service()
-    request = service.userProfiles().list()
-    return request.execute()['items']
+def get_profile_ids(refresh=False):
+    '''Same as get_profiles, but returns the set of profile ids'''
+    return _get_cached_profiles(refresh)['ids']
 
 
-def run_and_download_report(profileId, reportId, path=None, check_interval=10):
+def _get_profile_cache():
+
+    global _profile_cache
+
+    if _profile_cache is None or _profile_cache.ttl != profile_cache_ttl:
+        _profile_cache = TTLCache(maxsize=1, ttl=profile_cache_ttl)
+
+    return _profile_cache
+
+
+def _get_cached_profiles(refresh=False):
+
+    with _profile_cache_lock:
+        cache = _get_profile_cache()
+
+        if refresh:
+            cache.clear()
+
+        try:
+            return cache['profiles']
+        except KeyError:
+            pass
+
+        service = create_service()
+        request = service.userProfiles().list()
+        items = request.execute()['items']
+
+        profiles = {'items': items,
+                    'ids': frozenset(x['profileId'] for x in items)}
+        cache['profiles'] = profiles
+
+        return profiles
+
+
+def invalidate_profile_cache():
+    with _profile_cache_lock:
+        _get_profile_cache().clear()
+
+
+def start_report(profileId, reportId, path=None):
+    '''Run a report. Returns the report, the file_id and the download path'''
+
     report = Report(reportId=reportId, profileId=profileId)
     print(f"Running report '{report.name}'...")
 
-    report = Report(profileId, reportId)
     # today = dt.datetime.today().strftime('%Y-%m-%d')
 
     if path is None:
@@ -255,24 +713,62 @@ def run_and_download_report(profileId, reportId, path=None, check_interval=10):
         else:
             filename = filename + ".csv"
 
-        path = os.path.join(os.getcwd(), f'{report.filename}')
+        path = os.path.join(os.getcwd(), filename)
 
     file_id = report.run()
 
+    return report, file_id, path
+
+
+def wait_and_download(report, file_id, path, **poll_options):
+    '''
+    Wait for a report file to finish running, then download it to path.
+    poll_options are passed to Report.wait_for_file
+    '''
+
+    # The report may have been created on another thread
+    report._service = create_service()
+
+    report.wait_for_file(file_id, **poll_options)
+
     print(f"Downloading report '{report.name}'...")
-    time.sleep(check_interval)
-    flag = True
-    while flag:
-        try:
-            report.download_file(file_id, path)
-        except errors.HttpError:
-            print(f"Report '{report.name}' hasn't finished running. Trying again...")
-            time.sleep(check_interval)
+    report.download_file(file_id, path)
+    print(f"Downloaded {path}")
 
-            # check_interval += check_interval ** 2
-        else:
-            print(f"Downloaded {path}")
-            flag = False
+    return path
+
+
+@instrumentation.traced('run_and_download_report')
+def run_and_download_report(profileId, reportId, path=None, check_interval=10, **poll_options):
+    report, file_id, path = start_report(profileId, reportId, path)
+    return wait_and_download(report, file_id, path, check_interval=check_interval, **poll_options)
+
+
+def run_and_download_reports(jobs, max_workers=8, check_interval=10, **poll_options):
+    '''
+    Run several reports at once and download each file as soon as it is ready.
+
+    Args:
+    jobs - list of (profileId, reportId) or (profileId, reportId, path) tuples
+    max_workers (default 8) - number of reports run and polled concurrently
+    check_interval (default 10) - seconds before the second check on each report
+    poll_options - passed to Report.wait_for_file
+
+    Returns the downloaded paths, in the same order as jobs
+    '''
+    jobs = [tuple(job) + (None,) * (3 - len(job)) for job in jobs]
+
+    if not jobs:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        started = list(pool.map(lambda job: start_report(*job), jobs))
+
+        futures = [pool.submit(wait_and_download, report, file_id, path,
+                               check_interval=check_interval, **poll_options)
+                   for report, file_id, path in started]
+
+        return [future.result() for future in futures]
 
 
 if __name__ == '__main__':
@@ -5,9 +5,10 @@ from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 
 
-def run(scope, secret_path):
+def run(scope, secret_path, argv=None):
+    '''Run the OAuth flow and store the credentials. argv defaults to sys.argv[1:]'''
     parser = argparse.ArgumentParser(parents=[tools.argparser])
-    flags = parser.parse_args()
+    flags = parser.parse_args(argv)
 
     storage = Storage(os.path.join(os.path.split(__file__)[0], 'credentials.json'))
     flow = flow_from_clientsecrets(secret_path,
@@ -0,0 +1,87 @@
+# dimensions.py
+
+"""
+Lookup between the display names of standard DCM dimensions (as shown in the
+DCM interface) and their API names. standard_dimensions.json is read once per
+process, the first time a lookup is made.
+"""
+
+
+import difflib
+import json
+import os
+from functools import lru_cache
+from types import MappingProxyType
+
+
+standard_dimensions_path = os.path.join(os.path.split(__file__)[0], 'standard_dimensions.json')
+
+
+class DimensionIndex(object):
+
+    def __init__(self, standard_dimensions):
+        self.api_names = MappingProxyType({name.lower(): entry['API Name']
+                                           for name, entry in standard_dimensions.items()})
+        self.display_names = MappingProxyType({api_name: name
+                                               for name, api_name in self.api_names.items()})
+        self.types = MappingProxyType({entry['API Name']: entry['Type']
+                                       for entry in standard_dimensions.values()})
+
+    def api_name(self, dimension):
+        '''API name of a dimension, given either its display name or API name'''
+
+        if dimension in self.display_names:
+            return dimension
+
+        try:
+            return self.api_names[dimension.lower()]
+        except KeyError:
+            raise ValueError(self._unknown_message([dimension])) from None
+
+    def display_name(self, api_name):
+
+        try:
+            return self.display_names[api_name]
+        except KeyError:
+            raise ValueError(self._unknown_message([api_name])) from None
+
+    def resolve(self, dimensions):
+        '''API names for a list of dimensions, reporting every unknown name at once'''
+
+        unknown = [d for d in dimensions if d not in self.display_names and d.lower() not in self.api_names]
+
+        if unknown:
+            raise ValueError(self._unknown_message(unknown))
+
+        return [self.api_name(d) for d in dimensions]
+
+    def _unknown_message(self, dimensions):
+        messages = []
+
+        for dimension in dimensions:
+            matches = difflib.get_close_matches(dimension.lower(), self.api_names.keys(), n=3)
+            message = f"'{dimension}'"
+            if matches:
+                message += " (did you mean " + ", ".join(f"'{m}'" for m in matches) + "?)"
+            messages.append(message)
+
+        return "Unknown dimension(s): " + "; ".join(messages)
+
+    def __contains__(self, dimension):
+        return dimension in self.display_names or dimension.lower() in self.api_names
+
+    def __len__(self):
+        return len(self.api_names)
+
+
+@lru_cache(maxsize=None)
+def get_dimension_index():
+
+    with open(standard_dimensions_path, "r") as f:
+        standard_dimensions = json.load(f)
+
+    return DimensionIndex(standard_dimensions)
+
+
+def resolve(dimensions):
+    return get_dimension_index().resolve(dimensions)
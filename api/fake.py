@@ -0,0 +1,453 @@
+# fake.py
+
+"""
+In-process stand-in for the parts of the dfareporting API this package uses,
+for running the api module offline: tests, and load tests of polling,
+download streaming and concurrent scheduling.
+
+>>> from api import fake
+>>> server = fake.FakeDCM(latency=0.05, run_duration=2, file_size=20 * 1024 ** 2)
+>>> server.add_profile(1234)
+>>> server.add_report(1234, 5678)
+>>> api.set_service_factory(server.service_factory)
+>>> api.run_and_download_report(1234, 5678, path='report.csv', check_interval=0.5)
+>>> api.set_service_factory(None)
+
+Supported: userProfiles.list/get, reports.get/list/update/run,
+reports.files.list/get and files.list/get/get_media. get_media requests expose
+uri, headers and http like googleapiclient's, and honour Range headers.
+"""
+
+
+import copy
+import json
+import random
+import threading
+import time
+from collections import deque
+from datetime import date, timedelta
+
+import httplib2
+from googleapiclient import errors
+
+import instrumentation
+
+
+class FakeDCM(object):
+    '''
+    Reports, files and user profiles held in memory, served through
+    FakeService objects.
+
+    Args:
+    latency (default 0) - seconds added to every request. A (low, high) tuple
+    picks a random latency in that range for each request
+    run_duration (default 0) - seconds a report run takes before its file
+    becomes available
+    file_size (default 1 MB) - approximate size of every report file, in bytes
+    bandwidth (default None) - bytes per second when downloading files
+    error_rate (default 0) - share of requests failing with a 403 quota error
+    max_qps (default None) - requests allowed per second, any request above
+    that fails with a 403 rate limit error
+    page_size (default 10) - files per page when listing files
+    seed (default 0) - seed for latencies, errors and file contents
+    '''
+
+    def __init__(self, latency=0, run_duration=0, file_size=1024 ** 2, bandwidth=None,
+                 error_rate=0, max_qps=None, page_size=10, seed=0):
+        self.latency = latency
+        self.run_duration = run_duration
+        self.file_size = file_size
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.max_qps = max_qps
+        self.page_size = page_size
+
+        self.profiles = {}
+        self.reports = {}
+        self.files = {}
+        self.calls = {}
+
+        self._random = random.Random(seed)
+        self._contents = {}
+        self._recent_calls = deque()
+        self._next_file_id = 1
+        self._lock = threading.RLock()
+
+    # Setup
+
+    def add_profile(self, profileId, userName='fake.user', accountName='Fake Account'):
+        profile = {'kind': 'dfareporting#userProfile',
+                   'profileId': str(profileId),
+                   'userName': userName,
+                   'accountName': accountName}
+
+        with self._lock:
+            self.profiles[str(profileId)] = profile
+
+        return profile
+
+    def add_report(self, profileId, reportId, name=None, fileName=None, format='CSV',
+                   dimensions=None, metrics=None, run_duration=None, file_size=None):
+        '''
+        Add a report owned by profileId. run_duration and file_size override
+        the server defaults for this report.
+        '''
+        reportId = str(reportId)
+        name = name or f'Fake Report {reportId}'
+
+        body = {'kind': 'dfareporting#report',
+                'id': reportId,
+                'ownerProfileId': str(profileId),
+                'name': name,
+                'fileName': fileName or name.replace(' ', '_'),
+                'format': format,
+                'type': 'STANDARD',
+                'lastModifiedTime': _now_ms(),
+                'criteria': {'dateRange': {'relativeDateRange': 'LAST_30_DAYS'},
+                             'dimensions': [{'name': name} for name in dimensions or ['dfa:date', 'dfa:placementId']],
+                             'metricNames': metrics or ['dfa:impressions']}}
+
+        with self._lock:
+            self.reports[reportId] = {'profileId': str(profileId), 'body': body,
+                                      'run_duration': run_duration, 'file_size': file_size}
+            self.files.setdefault(reportId, [])
+
+        return body
+
+    def service_factory(self, api_name='dfareporting', version='v2.8', credentials='credentials.json'):
+        '''Takes the arguments of api.build_service, for api.set_service_factory'''
+        return FakeService(self)
+
+    # Request handling
+
+    def _begin(self, method):
+        '''Count, delay and possibly fail a request'''
+
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+            if isinstance(self.latency, (tuple, list)):
+                latency = self._random.uniform(*self.latency)
+            else:
+                latency = self.latency
+
+            failed = self.error_rate and self._random.random() < self.error_rate
+
+            now = time.time()
+            self._recent_calls.append(now)
+            while self._recent_calls[0] <= now - 1:
+                self._recent_calls.popleft()
+
+            limited = self.max_qps is not None and len(self._recent_calls) > self.max_qps
+
+        if latency:
+            time.sleep(latency)
+
+        if failed:
+            return _error_response(403, 'quotaExceeded', 'Quota exceeded for quota group')
+
+        if limited:
+            return _error_response(403, 'userRateLimitExceeded', 'User Rate Limit Exceeded')
+
+        return None
+
+    def _report(self, reportId):
+        try:
+            return self.reports[str(reportId)]
+        except KeyError:
+            raise _http_error(404, 'notFound', f'Report {reportId} not found')
+
+    def _file(self, reportId, fileId):
+        for file in self.files.get(str(reportId), []):
+            if file['id'] == str(fileId):
+                return file
+
+        raise _http_error(404, 'notFound', f'File {fileId} not found')
+
+    def _refresh_status(self, file):
+        if file['status'] == 'PROCESSING' and time.time() >= file['_ready_at']:
+            file['status'] = 'REPORT_AVAILABLE'
+            file['lastModifiedTime'] = _now_ms()
+
+    def _public(self, file):
+        self._refresh_status(file)
+        return {k: v for k, v in file.items() if not k.startswith('_')}
+
+    def list_profiles(self):
+        with self._lock:
+            return {'kind': 'dfareporting#userProfileList',
+                    'items': [copy.deepcopy(p) for p in self.profiles.values()]}
+
+    def get_profile(self, profileId):
+        with self._lock:
+            if str(profileId) not in self.profiles:
+                raise _http_error(403, 'insufficientPermissions', f'No access to profile {profileId}')
+            return copy.deepcopy(self.profiles[str(profileId)])
+
+    def get_report(self, profileId, reportId):
+        with self._lock:
+            return copy.deepcopy(self._report(reportId)['body'])
+
+    def list_reports(self, profileId, **params):
+        with self._lock:
+            items = [copy.deepcopy(r['body']) for r in self.reports.values() if r['profileId'] == str(profileId)]
+
+        return {'kind': 'dfareporting#reportList', 'items': items}
+
+    def update_report(self, profileId, reportId, body):
+        with self._lock:
+            report = self._report(reportId)
+            body = copy.deepcopy(body)
+            body.update(id=str(reportId), ownerProfileId=report['profileId'], lastModifiedTime=_now_ms())
+            report['body'] = body
+
+            return copy.deepcopy(body)
+
+    def run_report(self, profileId, reportId, synchronous=False):
+        with self._lock:
+            report = self._report(reportId)
+            body = report['body']
+
+            run_duration = self.run_duration if report['run_duration'] is None else report['run_duration']
+
+            file = {'kind': 'dfareporting#file',
+                    'id': str(self._next_file_id),
+                    'reportId': str(reportId),
+                    'fileName': body['fileName'],
+                    'format': body['format'],
+                    'status': 'PROCESSING',
+                    'lastModifiedTime': _now_ms(),
+                    'dateRange': copy.deepcopy(body['criteria']['dateRange']),
+                    '_ready_at': time.time() + run_duration,
+                    '_size': self.file_size if report['file_size'] is None else report['file_size']}
+
+            self._next_file_id += 1
+            self.files[str(reportId)].append(file)
+
+            return self._public(file)
+
+    def list_files(self, reportId=None, maxResults=None, pageToken=None,
+                   sortField='LAST_MODIFIED_TIME', sortOrder='DESCENDING', **params):
+        with self._lock:
+            if reportId is None:
+                files = [f for report_files in self.files.values() for f in report_files]
+            else:
+                self._report(reportId)
+                files = self.files[str(reportId)]
+
+            files = [self._public(f) for f in files]
+
+        key = (lambda f: int(f['lastModifiedTime'])) if sortField == 'LAST_MODIFIED_TIME' else (lambda f: int(f['id']))
+        files.sort(key=key, reverse=sortOrder == 'DESCENDING')
+
+        start = int(pageToken or 0)
+        end = start + (maxResults or self.page_size)
+
+        response = {'kind': 'dfareporting#fileList', 'items': files[start:end]}
+        if end < len(files):
+            response['nextPageToken'] = str(end)
+
+        return response
+
+    def get_file(self, reportId, fileId):
+        with self._lock:
+            return self._public(self._file(reportId, fileId))
+
+    def file_content(self, reportId, fileId):
+        '''The bytes of an available report file, generated once per file'''
+
+        with self._lock:
+            file = self._file(reportId, fileId)
+            self._refresh_status(file)
+
+            if file['status'] != 'REPORT_AVAILABLE':
+                raise _http_error(404, 'notFound', f'File {fileId} is not available yet')
+
+            if file['id'] not in self._contents:
+                self._contents[file['id']] = _csv_report(file['_size'], random.Random(int(file['id'])),
+                                                        file['dateRange'])
+
+            return self._contents[file['id']]
+
+
+class FakeRequest(object):
+    '''Stand-in for googleapiclient's HttpRequest'''
+
+    def __init__(self, server, method, func, *args, **kwargs):
+        self.server = server
+        self.method = method
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def execute(self, http=None, num_retries=0):
+        instrumentation.count('api_calls')
+
+        error = self.server._begin(self.method)
+        if error is not None:
+            raise errors.HttpError(*error, uri=self.method)
+
+        return self.func(*self.args, **self.kwargs)
+
+
+class FakeMediaRequest(object):
+    '''
+    Stand-in for a files.get_media request. The download is made through
+    http.request(uri, headers=...), which honours Range headers.
+    '''
+
+    def __init__(self, server, reportId, fileId):
+        self.uri = f'fake://dfareporting/reports/{reportId}/files/{fileId}?alt=media'
+        self.headers = {}
+        self.http = FakeHttp(server, reportId, fileId)
+
+    def execute(self, http=None, num_retries=0):
+        instrumentation.count('api_calls')
+
+        resp, content = self.http.request(self.uri, headers=self.headers)
+        if resp.status >= 400:
+            raise errors.HttpError(resp, content, uri=self.uri)
+        return content
+
+
+class FakeHttp(object):
+
+    def __init__(self, server, reportId, fileId):
+        self.server = server
+        self.reportId = reportId
+        self.fileId = fileId
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        error = self.server._begin('files.get_media')
+        if error is not None:
+            return error
+
+        try:
+            content = self.server.file_content(self.reportId, self.fileId)
+        except errors.HttpError as e:
+            return e.resp, e.content
+
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        total = len(content)
+        status = 200
+        response_headers = {}
+
+        if 'range' in headers:
+            first, _, last = headers['range'].replace('bytes=', '').partition('-')
+            first = int(first)
+            last = min(int(last) if last else total - 1, total - 1)
+
+            if first >= total:
+                return httplib2.Response({'status': 416, 'content-range': f'bytes */{total}'}), b''
+
+            content = content[first:last + 1]
+            status = 206
+            response_headers['content-range'] = f'bytes {first}-{last}/{total}'
+
+        if self.server.bandwidth:
+            time.sleep(len(content) / self.server.bandwidth)
+
+        response_headers.update(status=status, **{'content-length': str(len(content))})
+
+        return httplib2.Response(response_headers), content
+
+
+class FakeService(object):
+    '''Same resource methods as a dfareporting service built by googleapiclient'''
+
+    def __init__(self, server):
+        self.server = server
+
+    def userProfiles(self):
+        return _Resource(self.server, 'userProfiles',
+                         list=self.server.list_profiles,
+                         get=self.server.get_profile)
+
+    def reports(self):
+        server = self.server
+        resource = _Resource(server, 'reports',
+                             get=server.get_report,
+                             list=server.list_reports,
+                             update=server.update_report,
+                             run=server.run_report)
+
+        resource.files = lambda: _Resource(server, 'reports.files',
+                                           list=lambda profileId, reportId, **params: server.list_files(reportId, **params),
+                                           get=lambda profileId, reportId, fileId: server.get_file(reportId, fileId))
+        return resource
+
+    def files(self):
+        server = self.server
+        resource = _Resource(server, 'files',
+                             list=lambda profileId, **params: server.list_files(**params),
+                             get=server.get_file)
+
+        resource.get_media = lambda reportId, fileId: FakeMediaRequest(server, str(reportId), str(fileId))
+        return resource
+
+
+class _Resource(object):
+
+    def __init__(self, server, name, **methods):
+        self._server = server
+        self._name = name
+        self._methods = methods
+
+    def __getattr__(self, method):
+        try:
+            func = self._methods[method]
+        except KeyError:
+            raise AttributeError(f'{self._name} has no method {method}')
+
+        def request(**kwargs):
+            return FakeRequest(self._server, f'{self._name}.{method}', func, **kwargs)
+
+        return request
+
+
+def _now_ms():
+    return str(int(time.time() * 1000))
+
+
+def _error_response(status, reason, message):
+    content = json.dumps({'error': {'code': status, 'message': message,
+                                    'errors': [{'domain': 'usageLimits', 'reason': reason, 'message': message}]}})
+    return httplib2.Response({'status': status}), content.encode()
+
+
+def _http_error(status, reason, message):
+    resp, content = _error_response(status, reason, message)
+    return errors.HttpError(resp, content)
+
+
+def _report_days(date_range):
+    '''Days covered by a dateRange: its own for absolute ranges, July 2018 otherwise'''
+
+    if 'startDate' in date_range:
+        first, last = (date(*map(int, date_range[key].split('-'))) for key in ('startDate', 'endDate'))
+    else:
+        first, last = date(2018, 7, 1), date(2018, 7, 30)
+
+    return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+
+def _csv_report(size, rng, date_range):
+    '''A DCM style CSV export of roughly size bytes over the days of date_range'''
+
+    days = _report_days(date_range)
+
+    preamble = ('Fake Report\n\n'
+                f'Date/Time Generated,"{time.strftime("%b %d, %Y %I:%M %p")}"\n'
+                f'Date Range,"{days[0]:%b %d, %Y} - {days[-1]:%b %d, %Y}"\n\n'
+                'Report Fields\n'
+                'Date,Placement ID,Impressions\n')
+
+    rows = ''.join(f'{days[i % len(days)]:%Y-%m-%d},{rng.randint(100000000, 999999999)},{rng.randint(0, 50000)}\n'
+                   for i in range(1000))
+
+    body = rows * max(1, (size - len(preamble)) // len(rows))
+    remaining = size - len(preamble) - len(body)
+    if remaining > 0:
+        body += rows[:rows.rfind('\n', 0, remaining) + 1]
+
+    return (preamble + body + 'Grand Total:,---,0\n').encode()
@@ -0,0 +1,126 @@
+# file_index.py
+
+"""
+Local SQLite index of report file metadata, so the latest file of a report can
+be found without listing every file again.
+
+The shared index is kept in the user's cache folder, or at the path given to
+set_file_index.
+"""
+
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def default_index_path():
+    '''file_index.sqlite in the user's cache folder, outside the installed package'''
+
+    cache_path = (os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME')
+                  or os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(cache_path, 'dcm-reports', 'file_index.sqlite')
+
+
+class FileIndex(object):
+
+    def __init__(self, path=None):
+        self.path = default_index_path() if path is None else path
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                                report_id TEXT NOT NULL,
+                                file_id TEXT NOT NULL,
+                                status TEXT,
+                                last_modified INTEGER,
+                                resource TEXT NOT NULL,
+                                PRIMARY KEY (report_id, file_id))''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS files_by_time
+                            ON files (report_id, status, last_modified)''')
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call keeps the index usable from several threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def upsert(self, files):
+        rows = [(str(f['reportId']), str(f['id']), f.get('status'),
+                 int(f.get('lastModifiedTime', 0)), json.dumps(f))
+                for f in files]
+
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', rows)
+
+    def get(self, reportId, fileId):
+        with self._connect() as conn:
+            row = conn.execute('SELECT resource FROM files WHERE report_id = ? AND file_id = ?',
+                               (str(reportId), str(fileId))).fetchone()
+
+        return None if row is None else json.loads(row[0])
+
+    def files(self, reportId, status=None):
+        '''Indexed files of a report, most recently modified first'''
+
+        query = 'SELECT resource FROM files WHERE report_id = ?'
+        params = [str(reportId)]
+
+        if status is not None:
+            query += ' AND status = ?'
+            params.append(status)
+
+        query += ' ORDER BY last_modified DESC'
+
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def latest(self, reportId, status='REPORT_AVAILABLE'):
+        with self._connect() as conn:
+            row = conn.execute('''SELECT resource FROM files WHERE report_id = ? AND status = ?
+                                  ORDER BY last_modified DESC LIMIT 1''',
+                               (str(reportId), status)).fetchone()
+
+        return None if row is None else json.loads(row[0])
+
+    def clear(self, reportId=None):
+        with self._connect() as conn:
+            if reportId is None:
+                conn.execute('DELETE FROM files')
+            else:
+                conn.execute('DELETE FROM files WHERE report_id = ?', (str(reportId),))
+
+
+def get_file_index():
+    '''The FileIndex shared by all reports in the process'''
+
+    global _default_index
+
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = FileIndex()
+
+        return _default_index
+
+
+def set_file_index(path=None):
+    '''Keep the shared file index at path, or at default_index_path() when path is None'''
+
+    global _default_index
+
+    with _default_index_lock:
+        _default_index = None if path is None else FileIndex(path)
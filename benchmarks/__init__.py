@@ -0,0 +1,8 @@
+"""
+Offline benchmarks of the reporting pipeline on synthetic data. Run with:
+
+    python -m benchmarks --scale medium --output results.json
+    python -m benchmarks --scale medium --compare results.json
+"""
+
+from .suite import run, main
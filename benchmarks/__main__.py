@@ -0,0 +1,4 @@
+from .suite import main
+
+
+main()
@@ -0,0 +1,144 @@
+# generators.py
+"""
+Synthetic inputs shaped like the files the pipeline reads in production: DCM
+CSV exports, Prisma media plans and programmatic delivery workbooks.
+
+All generators are seeded, so the same scale always produces the same files
+and timings can be compared between runs. The three sources share campaign
+names, placement names and placement IDs, so they merge the way real reports
+do.
+"""
+
+import csv
+
+import numpy as np
+import pandas as pd
+
+
+def placement_table(placements, campaigns=4, seed=0):
+    """Campaign, site, placement name and 9 digit placement ID for each placement"""
+
+    rng = np.random.RandomState(seed)
+
+    # One ID drawn from each of placements equal slices of the 9 digit range,
+    # so they are unique without sampling the whole range
+    step = 900000000 // placements
+    ids = rng.permutation(100000000 + np.arange(placements) * step + rng.randint(0, step, placements))
+    sizes = np.array(["300x250", "728x90", "160x600", "320x50"])
+
+    return pd.DataFrame({
+        "Campaign": [f"Campaign {i * campaigns // placements + 1}" for i in range(placements)],
+        "Site (DCM)": [f"Site {i % 25 + 1}" for i in range(placements)],
+        "Placement": [f"Placement {i + 1}_{sizes[i % len(sizes)]}" for i in range(placements)],
+        "Placement ID": ids,
+    })
+
+
+def write_dcm_report(path, placements=500, days=90, start="2018-07-01", seed=0):
+    """
+    Write a DCM CSV export with one row per placement per day, wrapped in the
+    usual metadata preamble and "Grand Total" footer. Returns the number of
+    data rows.
+    """
+
+    rng = np.random.RandomState(seed)
+    table = placement_table(placements, seed=seed)
+    dates = pd.date_range(start, periods=days)
+
+    df = table.loc[table.index.repeat(days)].reset_index(drop=True)
+    df.insert(0, "Date", np.tile(dates.strftime("%Y-%m-%d"), placements))
+    df["Impressions"] = rng.randint(0, 50000, len(df))
+    df["Clicks"] = (df["Impressions"] * rng.uniform(0, 0.01, len(df))).astype(int)
+    df["Media Cost"] = np.round(df["Impressions"] * rng.uniform(0.001, 0.01, len(df)), 2)
+
+    preamble = [["Synthetic Report"], [],
+                ["Report Time Zone", "America/New_York"],
+                ["Date/Time Generated", f"{dates[-1] + pd.Timedelta(days=1):%b %d, %Y} 9:00 AM"],
+                ["Date Range", f"{dates[0]:%b %d, %Y} - {dates[-1]:%b %d, %Y}"],
+                ["Dimensions", "Date, Campaign, Site (DCM), Placement, Placement ID"],
+                [], ["Report Fields"]]
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerows(preamble)
+        df.to_csv(f, index=False)
+
+        totals = ["Grand Total:"] + ["---"] * 4 + [df[c].sum() for c in ["Impressions", "Clicks", "Media Cost"]]
+        writer.writerow(totals)
+
+    return len(df)
+
+
+def write_media_plan(path, placements=500, package_share=0.2, children=4, start="2018-07-01", seed=0):
+    """
+    Write a Prisma media plan export. Roughly package_share of the placements
+    are grouped into packages of the given number of children. Returns the
+    number of rows in the plan.
+    """
+
+    rng = np.random.RandomState(seed)
+    table = placement_table(placements, seed=seed)
+
+    columns = ["Campaign Name", "Name", "Supplier", "Unit Dimensions", "Units",
+               "Cost", "Rate", "Start Date", "End Date"]
+
+    start = pd.Timestamp(start)
+    rows = []
+    index = 0
+    package = 0
+
+    while index < placements:
+        campaign, site, name = table.loc[index, ["Campaign", "Site (DCM)", "Placement"]]
+        flight_end = start + pd.Timedelta(days=int(rng.randint(28, 180)))
+        dates = [f"{start:%Y-%m-%d}", f"{flight_end:%Y-%m-%d}"]
+
+        units = int(rng.randint(10, 5000)) * 1000
+        rate = round(float(rng.uniform(1, 20)), 2)
+        cost = units / 1000 * rate
+
+        if rng.random_sample() < package_share and index + children <= placements:
+            package += 1
+            rows.append([campaign, f"Package {package}", site, "", f"{units:,}", f"${cost:,.2f}",
+                         f"${rate:,.2f}"] + dates)
+
+            for child in table["Placement"][index:index + children]:
+                rows.append([campaign, child, "", child.rsplit("_", 1)[-1], "", "", ""] + ["", ""])
+
+            index += children
+
+        else:
+            rows.append([campaign, name, site, name.rsplit("_", 1)[-1], f"{units:,}", f"${cost:,.2f}",
+                         f"${rate:,.2f}"] + dates)
+            index += 1
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+    return len(rows)
+
+
+def write_programmatic_report(path, placements=500, days=90, start="2018-07-01", sheet="Raw Data", seed=0):
+    """
+    Write a programmatic delivery workbook with one row per placement per day.
+    The placement ID column is deliberately not called "Placement ID", as in
+    most vendor reports. Returns the number of data rows.
+    """
+
+    rng = np.random.RandomState(seed + 1)
+    table = placement_table(placements, seed=seed)
+    dates = pd.date_range(start, periods=days)
+
+    df = pd.DataFrame({
+        "Date": np.tile(dates, placements),
+        "Advertiser": "Synthetic Advertiser",
+        "Line Item": np.repeat(table["Placement"].values, days),
+        "DCM Placement ID": np.repeat(table["Placement ID"].astype(str).values, days),
+        "Impressions": rng.randint(0, 50000, placements * days),
+    })
+    df["Spend"] = np.round(df["Impressions"] * rng.uniform(0.001, 0.01, len(df)), 2)
+
+    df.to_excel(path, sheet_name=sheet, index=False, engine="openpyxl")
+
+    return len(df)
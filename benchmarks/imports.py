@@ -0,0 +1,57 @@
+# imports.py
+"""
+Cold-start cost of importing the packages, each measured in a fresh
+interpreter so nothing is already loaded in sys.modules.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the child process: argv[1] is the statement, argv[2] whether to trace memory
+_script = """
+import json, sys, time, tracemalloc
+if sys.argv[2] == '1':
+    tracemalloc.start()
+start = time.perf_counter()
+exec(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'peak': tracemalloc.get_traced_memory()[1]}))
+"""
+
+
+class ImportBenchmark(object):
+    """Times a statement such as "import tools" in a new Python process"""
+
+    def __init__(self, statement):
+        self.name = statement
+        self.statement = statement
+
+    def _measure(self, trace_memory=False):
+        output = subprocess.run([sys.executable, '-c', _script, self.statement, '1' if trace_memory else '0'],
+                                cwd=root, check=True, stdout=subprocess.PIPE).stdout
+        return json.loads(output.decode().strip().splitlines()[-1])
+
+    def run(self, repeat=5):
+        # tracemalloc slows imports down, so memory is measured in a separate run
+        timings = [self._measure()['seconds'] for _ in range(repeat)]
+        peak = self._measure(trace_memory=True)['peak']
+
+        return {'name': self.name,
+                'rows': None,
+                'repeat': repeat,
+                'best_s': round(min(timings), 6),
+                'mean_s': round(sum(timings) / len(timings), 6),
+                'rows_per_s': None,
+                'peak_mb': round(peak / 1024 ** 2, 3)}
+
+
+def import_suite():
+    return [ImportBenchmark('import tools'),
+            ImportBenchmark('import api'),
+            ImportBenchmark('from tools import redistribute_units'),
+            ImportBenchmark('from tools import load_dcm')]
@@ -0,0 +1,193 @@
+# suite.py
+"""
+Offline benchmarks of the reporting pipeline on synthetic data.
+
+Every benchmark is timed over a number of repeats, then run once more under
+tracemalloc to record its peak memory. The import benchmarks (e.g.
+"import tools") time cold starts in fresh interpreters. Results are written as
+JSON so two runs can be compared with --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import tools
+from tools.report_readers import load_from_csv
+
+from .generators import write_dcm_report, write_media_plan, write_programmatic_report
+from .imports import import_suite
+
+
+scales = {
+    'small': {'placements': 200, 'days': 30},
+    'medium': {'placements': 1000, 'days': 90},
+    'large': {'placements': 5000, 'days': 180},
+}
+
+
+class Benchmark(object):
+    """
+    A timed call. setup runs before every repeat and is not timed; its return
+    value is passed to func. rows is the number of input rows, used for
+    throughput.
+    """
+
+    def __init__(self, name, func, rows, setup=None):
+        self.name = name
+        self.func = func
+        self.rows = rows
+        self.setup = setup or (lambda: None)
+
+    def _call(self):
+        arg = self.setup()
+        start = time.perf_counter()
+        self.func(arg)
+        return time.perf_counter() - start
+
+    def run(self, repeat=5):
+        timings = [self._call() for _ in range(repeat)]
+
+        arg = self.setup()
+        tracemalloc.start()
+        try:
+            self.func(arg)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        best = min(timings)
+
+        return {'name': self.name,
+                'rows': self.rows,
+                'repeat': repeat,
+                'best_s': round(best, 6),
+                'mean_s': round(sum(timings) / len(timings), 6),
+                'rows_per_s': round(self.rows / best) if best else None,
+                'peak_mb': round(peak / 1024 ** 2, 3)}
+
+
+def build_inputs(folder, placements, days):
+    """Write the synthetic DCM report, media plan and programmatic workbook into folder"""
+
+    inputs = {'dcm': os.path.join(folder, 'dcm_report.csv'),
+              'plan': os.path.join(folder, 'Media Plan.csv'),
+              'programmatic': os.path.join(folder, 'programmatic', 'delivery.xlsx')}
+
+    os.makedirs(os.path.dirname(inputs['programmatic']))
+
+    rows = {'dcm': write_dcm_report(inputs['dcm'], placements, days),
+            'plan': write_media_plan(inputs['plan'], placements),
+            'programmatic': write_programmatic_report(inputs['programmatic'], placements, days)}
+
+    return inputs, rows
+
+
+def suite(inputs, rows):
+    """The benchmarks, in pipeline order"""
+
+    dcm = load_from_csv(inputs['dcm'])
+    merged = tools.merge_with_prisma(dcm.copy(), inputs['plan'])
+    merged['Placement Start Date'] = pd.to_datetime(merged['Placement Start Date'])
+    merged['Placement End Date'] = pd.to_datetime(merged['Placement End Date'])
+    end_of_month = pd.to_datetime(dcm['Date']).max()
+
+    def parse_plan(_):
+        tools.MediaPlan(inputs['plan']).parse()
+
+    def clear_programmatic_cache():
+        # Time the parse, not a cache hit
+        shutil.rmtree(os.path.join(os.path.dirname(inputs['programmatic']), '.cache'), ignore_errors=True)
+        return dcm.copy()
+
+    return [
+        Benchmark('load_from_csv', lambda _: load_from_csv(inputs['dcm']), rows['dcm']),
+        Benchmark('redistribute_units', lambda df: tools.redistribute_units(df, ['Placement'], 'Planned Units', 'Impressions'),
+                  len(merged), setup=lambda: merged),
+        Benchmark('MediaPlan.parse', parse_plan, rows['plan']),
+        Benchmark('merge_with_prisma', lambda df: tools.merge_with_prisma(df, inputs['plan']),
+                  rows['dcm'], setup=dcm.copy),
+        Benchmark('merge_with_programmatic_report',
+                  lambda df: tools.merge_with_programmatic_report(inputs['programmatic'], 'Raw Data', df,
+                                                                  merge_on=['Placement ID', 'Date']),
+                  rows['dcm'] + rows['programmatic'], setup=clear_programmatic_cache),
+        Benchmark('monthly_commitment', lambda df: tools.monthly_commitment(df, end_of_month), len(merged),
+                  setup=lambda: merged),
+    ]
+
+
+def run(placements, days, repeat=5, only=None):
+    """Generate the inputs in a temporary folder and run every benchmark (or those named in only)"""
+
+    with tempfile.TemporaryDirectory() as folder:
+        inputs, rows = build_inputs(folder, placements, days)
+
+        results = []
+        for benchmark in suite(inputs, rows) + import_suite():
+            if only and benchmark.name not in only:
+                continue
+
+            result = benchmark.run(repeat)
+            results.append(result)
+
+            throughput = '' if result['rows_per_s'] is None else f"{result['rows_per_s']:,} rows/s"
+            print(f"{benchmark.name:<40} {result['best_s']:>10.4f}s {throughput:>19} {result['peak_mb']:>10.1f} MB")
+
+    return {'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'placements': placements,
+            'days': days,
+            'results': results}
+
+
+def compare(current, previous):
+    """Print the change in best time and peak memory of every benchmark since a previous run"""
+
+    before = {result['name']: result for result in previous['results']}
+
+    for result in current['results']:
+        old = before.get(result['name'])
+        if old is None or not old['best_s']:
+            continue
+
+        print(f"{result['name']:<40} time x{result['best_s'] / old['best_s']:.2f}"
+              f"  memory x{result['peak_mb'] / old['peak_mb'] if old['peak_mb'] else float('nan'):.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(scales), default='small')
+    parser.add_argument('--placements', type=int, help="overrides the scale's number of placements")
+    parser.add_argument('--days', type=int, help="overrides the scale's number of days")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='run only these benchmarks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='JSON', help='compare with the results of a previous run')
+    args = parser.parse_args(argv)
+
+    placements = args.placements or scales[args.scale]['placements']
+    days = args.days or scales[args.scale]['days']
+
+    results = run(placements, days, repeat=args.repeat, only=args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
+
+    return results
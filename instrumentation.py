@@ -0,0 +1,295 @@
+# instrumentation.py
+"""
+Stage timing, counters and optional profiling for the api and tools modules.
+
+Instrumentation is off until a recorder is enabled. While it is off, span()
+returns a shared do-nothing context manager and count() returns at once, so
+instrumented code costs about one function call per stage.
+
+>>> import instrumentation
+>>> with instrumentation.record(memory=True) as recorder:
+...     df = tools.load_dcm(profileId, reportId, force_run=True)
+>>> recorder.print_summary()
+>>> recorder.write_json('timings.json')
+
+Spans nest per thread. Counters (e.g. api_calls, bytes_downloaded,
+rows_parsed) are added to the innermost open span and to the recorder's
+totals. With profile=True each outermost span is run under cProfile; with
+memory=True the peak memory allocated during each span is traced with
+tracemalloc. Memory is traced for the whole process, so spans running at the
+same time in other threads add to each other's peaks.
+"""
+
+import cProfile
+import csv
+import functools
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+# The active Recorder, or None when instrumentation is off
+_recorder = None
+
+_null_span = nullcontext()
+
+
+class Span(object):
+
+    def __init__(self, name, path, depth, thread, attributes):
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.thread = thread
+        self.attributes = attributes
+        self.counters = {}
+        self.start = None
+        self.duration = None
+        self.peak_memory = None
+        self.profile = None
+
+        # Highest traced memory seen before a child span reset the peak
+        self._child_peak = 0
+        self._start_memory = 0
+
+    def to_dict(self):
+        return {'name': self.name,
+                'path': self.path,
+                'depth': self.depth,
+                'thread': self.thread,
+                'start_s': round(self.start, 6),
+                'duration_s': None if self.duration is None else round(self.duration, 6),
+                'peak_memory_mb': None if self.peak_memory is None else round(self.peak_memory / 1024 ** 2, 3),
+                'counters': dict(self.counters),
+                'attributes': dict(self.attributes),
+                'profile': self.profile}
+
+
+class Recorder(object):
+    """
+    Collects the spans and counters of everything run while it is enabled.
+
+    args:
+    - profile: run each outermost span under cProfile and keep its top
+    functions by cumulative time
+    - memory: trace the peak memory of each span with tracemalloc
+    - profile_limit: number of functions kept per profiled span
+    """
+
+    def __init__(self, profile=False, memory=False, profile_limit=20):
+        self.profile = profile
+        self.memory = memory
+        self.profile_limit = profile_limit
+
+        self.spans = []
+        self.counters = {}
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiling = False
+        self._started_tracemalloc = False
+        self._origin = time.perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        path = name if parent is None else f"{parent.path}/{name}"
+
+        span = Span(name, path, len(stack), threading.current_thread().name, attributes)
+
+        with self._lock:
+            self.spans.append(span)
+
+        profiler = None
+        if self.profile and parent is None:
+            profiler = self._start_profiler()
+
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent._child_peak = max(parent._child_peak, peak)
+            span._start_memory = current
+            if hasattr(tracemalloc, 'reset_peak'):
+                # Python 3.9+, otherwise peaks are measured from the first span
+                tracemalloc.reset_peak()
+
+        stack.append(span)
+        span.start = time.perf_counter() - self._origin
+
+        try:
+            yield span
+
+        finally:
+            span.duration = time.perf_counter() - self._origin - span.start
+            stack.pop()
+
+            if self.memory and tracemalloc.is_tracing():
+                peak = max(tracemalloc.get_traced_memory()[1], span._child_peak)
+                span.peak_memory = peak - span._start_memory
+                if parent is not None:
+                    parent._child_peak = max(parent._child_peak, peak)
+
+            if profiler is not None:
+                span.profile = self._stop_profiler(profiler)
+
+    def _start_profiler(self):
+        # Only one profiler can run at a time in the process
+        with self._lock:
+            if self._profiling:
+                return None
+            self._profiling = True
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            with self._lock:
+                self._profiling = False
+            return None
+
+        return profiler
+
+    def _stop_profiler(self, profiler):
+        profiler.disable()
+
+        with self._lock:
+            self._profiling = False
+
+        stats = pstats.Stats(profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+
+        return [{'function': f"{filename}:{line}({function})",
+                 'calls': calls,
+                 'total_s': round(total_time, 6),
+                 'cumulative_s': round(cumulative_time, 6)}
+                for (filename, line, function), (_, calls, total_time, cumulative_time, _) in rows[:self.profile_limit]]
+
+    def count(self, name, value=1):
+        stack = self._stack()
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if stack:
+                stack[-1].counters[name] = stack[-1].counters.get(name, 0) + value
+
+    def to_dict(self):
+        return {'counters': dict(self.counters),
+                'spans': [span.to_dict() for span in self.spans]}
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_csv(self, path):
+        """One row per span, with a column per counter. Profiles are only written to JSON"""
+
+        counter_names = sorted(self.counters)
+        columns = ['name', 'path', 'depth', 'thread', 'start_s', 'duration_s', 'peak_memory_mb'] + counter_names
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+
+            for span in self.spans:
+                row = span.to_dict()
+                writer.writerow([row[c] for c in columns[:7]] + [span.counters.get(c, 0) for c in counter_names])
+
+    def print_summary(self):
+        for span in self.spans:
+            duration = 'running' if span.duration is None else f"{span.duration:.3f}s"
+            counters = ", ".join(f"{k}={v:,}" for k, v in span.counters.items())
+            print(f"{'  ' * span.depth}{span.name:<{40 - 2 * span.depth}} {duration:>10}  {counters}")
+
+        if self.counters:
+            print("Totals:", ", ".join(f"{k}={v:,}" for k, v in self.counters.items()))
+
+
+def enable(profile=False, memory=False, profile_limit=20):
+    """Start recording into a new Recorder and return it"""
+
+    global _recorder
+
+    disable()
+
+    recorder = Recorder(profile=profile, memory=memory, profile_limit=profile_limit)
+    recorder.start()
+    _recorder = recorder
+
+    return recorder
+
+
+def disable():
+    """Stop recording. Returns the recorder that was active, if any"""
+
+    global _recorder
+
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.stop()
+
+    return recorder
+
+
+@contextmanager
+def record(profile=False, memory=False, profile_limit=20):
+    """Record everything run inside the block"""
+
+    recorder = enable(profile=profile, memory=memory, profile_limit=profile_limit)
+    try:
+        yield recorder
+    finally:
+        if _recorder is recorder:
+            disable()
+
+
+def span(name, **attributes):
+    """Context manager timing a named stage, nested under any open span"""
+
+    if _recorder is None:
+        return _null_span
+
+    return _recorder.span(name, **attributes)
+
+
+def count(name, value=1):
+    """Add value to a counter"""
+
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+
+def traced(name):
+    """Decorator running every call of a function in a span"""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+
+            with _recorder.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
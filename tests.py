@@ -1,16 +1,43 @@
 from datetime import datetime, timedelta
+import csv
+import gc
+import gzip
 import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import weakref
+from unittest import mock
 
+import openpyxl
 import pandas as pd
+from googleapiclient import errors
 
 import api
+import api.dimensions
+import api.fake
+import instrumentation
 import tools
+from tools.store import PartitionStore
+from tools.watcher import snapshot, wait_for_download
 
 
 class TestReportTestCase(unittest.TestCase):
 
-    test_report = api.Report(4613164, 162405225)
+    def setUp(self):
+        self.server = api.fake.FakeDCM()
+        self.server.add_profile(4613164)
+        self.server.add_report(4613164, 162405225)
+        api.set_service_factory(self.server.service_factory)
+
+        self.test_report = api.Report(4613164, 162405225)
+
+    def tearDown(self):
+        api.set_service_factory(None)
 
 
 class ReportTests(TestReportTestCase):
@@ -22,7 +49,7 @@ class ReportTests(TestReportTestCase):
         dimensions = ["Advertiser", "Campaign", "Site (DCM)"]
         self.test_report.set_dimensions(dimensions)
 
-        with open("api/standard_dimensions.json", "r") as f:
+        with open(api.dimensions.standard_dimensions_path, "r") as f:
             standard_dimensions = json.load(f)
 
         api_dim_names = [standard_dimensions[dim.lower()]['API Name'] for dim in dimensions]
@@ -77,6 +104,40 @@ class ReportSetDateRangeTests(TestReportTestCase):
             self.test_report.set_date_range()
 
 
+class DimensionIndexTests(unittest.TestCase):
+
+    def test_resolve_display_and_api_names(self):
+        self.assertEqual(api.dimensions.resolve(["Placement", "site (dcm)", "dfa:creative"]),
+                         ["dfa:placement", "dfa:site", "dfa:creative"])
+
+    def test_display_name(self):
+        index = api.dimensions.get_dimension_index()
+        self.assertEqual(index.display_name("dfa:siteId"), "site id (dcm)")
+
+    def test_unknown_dimensions_error(self):
+        with self.assertRaises(ValueError) as context:
+            api.dimensions.resolve(["Placement", "Placment", "Not a dimension"])
+
+        self.assertIn("Placment", str(context.exception))
+        self.assertIn("Not a dimension", str(context.exception))
+
+    def test_index_loaded_once(self):
+        self.assertIs(api.dimensions.get_dimension_index(), api.dimensions.get_dimension_index())
+
+
+class PollingTests(unittest.TestCase):
+
+    def test_backoff_intervals_grow_up_to_maximum(self):
+        intervals = api.api.backoff_intervals(5, maximum=30, factor=2)
+        self.assertEqual([next(intervals) for _ in range(5)], [5, 10, 20, 30, 30])
+
+    def test_backoff_intervals_jitter(self):
+        intervals = api.api.backoff_intervals(10, factor=1, jitter=0.5)
+
+        for _ in range(100):
+            self.assertTrue(5 <= next(intervals) <= 15)
+
+
 class ToolsTests(unittest.TestCase):
 
     test_df = pd.DataFrame({'col1': ['a', 'a', 'a', 'b', 'b', 'c', 'c', 'c', 'c', ],
@@ -122,6 +183,147 @@ class ToolsTests(unittest.TestCase):
         for result, answer in zip(results, correct_answers):
             self.assertEqual(result, answer)
 
+    def test_redistribute_units_function_multiple_right_columns(self):
+        results = round(tools.redistribute_units(self.test_df, 'col1', ['col4', 'col3']), 3)
+
+        self.assertEqual(list(results.columns), ['col4', 'col3'])
+        self.assertEqual(list(results['col4']), [3.333, 3.333, 3.333, 5.0, 5.0, 2.5, 2.5, 2.5, 2.5])
+        self.assertEqual(list(results['col3']), [0.333, 0.667, 1.0, 0.5, 1.0, 0.25, 0.5, 0.75, 1.0])
+
+    def test_redistribute_units_function_multiple_right_columns_weighted(self):
+        df = self.test_df.assign(col5=[30, 30, 30, 4, 4, 100, 100, 100, 100])
+        results = round(tools.redistribute_units(df, 'col1', ['col5', 'col4'], weight_against='col3'), 3)
+
+        self.assertEqual(list(results.columns), ['col5', 'col4'])
+        self.assertEqual(list(results['col5']), [5.0, 10.0, 15.0, 1.333, 2.667, 10.0, 20.0, 30.0, 40.0])
+        self.assertEqual(list(results['col4']), [1.667, 3.333, 5.0, 3.333, 6.667, 1.0, 2.0, 3.0, 4.0])
+
+    def test_load_from_csv_skips_preamble_and_footer(self):
+        lines = ["Test Report", "",
+                 'Date/Time Generated,"Aug 1, 2018 10:00 AM"',
+                 'Date Range,"Jul 1, 2018 - Jul 31, 2018"', "",
+                 "Report Fields",
+                 "Placement ID,Placement,Impressions",
+                 '123456789,"Placement, A",100',
+                 "123456780,Placement B,250",
+                 "Grand Total:,---,350"]
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "report.csv")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+            df = tools.load_from_csv(path)
+
+        self.assertEqual(list(df.columns), ["Placement ID", "Placement", "Impressions"])
+        self.assertEqual(list(df["Placement ID"]), [123456789, 123456780])
+        self.assertEqual(list(df["Placement"]), ["Placement, A", "Placement B"])
+        self.assertEqual(df.date_generated, pd.Timestamp("2018-08-01 10:00"))
+        self.assertEqual([d.date() for d in df.date_range],
+                         [pd.Timestamp("2018-07-01").date(), pd.Timestamp("2018-07-31").date()])
+
+    def test_load_cached_csv_reuses_parsed_report(self):
+        lines = ["Test Report",
+                 'Date/Time Generated,"Aug 1, 2018 10:00 AM"',
+                 'Date Range,"Jul 1, 2018 - Jul 31, 2018"',
+                 "Report Fields",
+                 "Placement ID,Impressions",
+                 "123456789,100",
+                 "Grand Total:,100"]
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "report.csv")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+            first = tools.load_cached_csv(path, 1)
+            self.assertTrue(os.listdir(os.path.join(folder, ".cache")))
+
+            second = tools.load_cached_csv(path, 1)
+
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(first.date_generated, second.date_generated)
+        self.assertEqual(first.date_range, second.date_range)
+
+    def test_partition_store_upserts_whole_days(self):
+        df = pd.DataFrame({"Date": ["2018-07-01", "2018-07-01", "2018-07-02", "2018-07-03"],
+                           "Impressions": [1, 2, 3, 4]})
+        restated = pd.DataFrame({"Date": ["2018-07-02", "2018-07-04"], "Impressions": [30, 5]})
+
+        with tempfile.TemporaryDirectory() as folder:
+            store = PartitionStore(folder)
+            store.upsert(df)
+            store.upsert(restated, start="2018-07-02", end="2018-07-04")
+
+            self.assertEqual([d.day for d in store.dates()], [1, 2, 4])
+            self.assertEqual(list(store.load()["Impressions"]), [1, 2, 30, 5])
+            self.assertEqual(list(store.load(start="2018-07-02")["Impressions"]), [30, 5])
+
+    def test_frame_cache_hashes_source_once_per_cold_load(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "report.csv")
+            with open(path, "w") as f:
+                f.write("a,b\n1,2\n")
+
+            cache = tools.cache.FrameCache(os.path.join(folder, ".cache"))
+            df = pd.DataFrame({"a": [1], "b": [2]})
+
+            digest = tools.cache.file_digest
+            calls = []
+            tools.cache.file_digest = lambda p: calls.append(p) or digest(p)
+            try:
+                cache.put(path, "ns", df)
+                os.utime(path, ns=(0, 0))
+                self.assertIsNone(cache.get(path, "other"))
+                cache.put(path, "other", df)
+            finally:
+                tools.cache.file_digest = digest
+
+        self.assertEqual(len(calls), 2)
+
+    def test_find_matching_column(self):
+        df = pd.DataFrame({'Date': pd.date_range('2018-07-01', periods=200),
+                           'Site ID': [12345678] * 200,
+                           'Placement ID': list(range(123456700, 123456900)),
+                           'Spend': [1.5] * 200})
+
+        self.assertEqual(tools.programmatic.find_matching_column(df, r"^\d{9}$", use_cache=False),
+                         'Placement ID')
+
+        # A mismatch after the sample still rejects the column
+        df.loc[150, 'Placement ID'] = 5
+        with self.assertRaises(ValueError):
+            tools.programmatic.find_matching_column(df, r"^\d{9}$", use_cache=False)
+
+    def test_read_programmatic_report_is_cached(self):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.title = "Raw Data"
+        sheet.append(["Date", "Line Item", "DCM Placement ID", "Impressions", "Spend"])
+        for day in range(1, 6):
+            sheet.append([f"2018-07-0{day}", "Line Item 1", "123456789", 1000 * day, 1.5 * day])
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "delivery.xlsx")
+            workbook.save(path)
+
+            # A cold read opens the workbook once, and never through read_excel
+            with mock.patch.object(tools.programmatic.pd, "read_excel", side_effect=AssertionError), \
+                    mock.patch("openpyxl.load_workbook", wraps=openpyxl.load_workbook) as load_workbook:
+                df, placement_id_col = tools.programmatic.read_programmatic_report(path, "Raw Data", ["Date", "Spend"],
+                                                                                   sample_size=2)
+
+            self.assertEqual(load_workbook.call_count, 1)
+
+            with mock.patch("openpyxl.load_workbook", side_effect=AssertionError):
+                cached, cached_col = tools.programmatic.read_programmatic_report(path, "Raw Data", ["Spend", "Date"])
+
+        self.assertEqual(placement_id_col, "DCM Placement ID")
+        self.assertEqual(list(df.columns), ["Date", "DCM Placement ID", "Spend"])
+        self.assertEqual(df["Spend"].tolist(), [1.5, 3.0, 4.5, 6.0, 7.5])
+        self.assertEqual(cached_col, placement_id_col)
+        pd.testing.assert_frame_equal(cached, df)
+
     def test_merge_with_programmatic_function_merge_on_error(self):
 
         with self.assertRaises(ValueError):
@@ -129,6 +331,606 @@ class ToolsTests(unittest.TestCase):
                                                  merge_on=["Date"])
 
 
+class MediaPlanTests(unittest.TestCase):
+
+    columns = ["Campaign Name", "Name", "Supplier", "Unit Dimensions", "Units",
+               "Cost", "Rate", "Start Date", "End Date"]
+
+    rows = [["Campaign", "Placement A", "Site", "300x250", "1,000", "$10.00", "$10.00", "2018-07-01", "2018-07-31"],
+            ["Campaign", "Package", "Site", "", "3,000", "$1,500.00", "$0.50", "2018-07-01", "2018-08-31"],
+            ["Campaign", "Package Child 1", "", "300x250", "", "", "", "", ""],
+            ["Campaign", "Package Child 2", "", "728x90", "", "", "", "", ""],
+            ["Campaign", "Placement B", "Site", "728x90", "2,000", "$40.00", "$20.00", "2018-08-01", "2018-08-31"]]
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "Media Plan.csv")
+
+        with open(self.path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(self.rows)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_parse_splits_packages_between_children(self):
+        plan = tools.MediaPlan(self.path)
+        plan.parse()
+
+        self.assertEqual(plan.output, [
+            ("Campaign", "Placement A", 1000.0, 10.0, 10.0, "2018-07-01", "2018-07-31"),
+            ("Campaign", "Placement B", 2000.0, 40.0, 20.0, "2018-08-01", "2018-08-31"),
+            ("Campaign", "Package Child 1", 1500.0, 750.0, 0.5, "2018-07-01", "2018-08-31"),
+            ("Campaign", "Package Child 2", 1500.0, 750.0, 0.5, "2018-07-01", "2018-08-31")])
+
+        self.assertEqual(list(plan.packages), ["Package"])
+
+    def test_to_frame_matches_parse(self):
+        plan = tools.MediaPlan(self.path)
+        plan.parse()
+        expected = pd.DataFrame(plan.output, columns=tools.prisma.plan_columns)
+
+        df = tools.MediaPlan(self.path).to_frame()
+
+        self.assertEqual(str(df["Placement"].dtype), "category")
+        self.assertEqual(list(df["Placement"]), list(expected["Placement"]))
+        self.assertEqual(list(df["Planned Units"]), list(expected["Planned Units"]))
+        self.assertEqual(list(df["Planned Cost"]), list(expected["Planned Cost"]))
+        self.assertEqual(list(df["Rate"]), list(expected["Rate"]))
+        self.assertEqual(list(df["Placement End Date"]), list(pd.to_datetime(expected["Placement End Date"])))
+
+    def test_load_media_plans_combines_folder(self):
+        other_path = os.path.join(self.folder.name, "Other Media Plan.csv")
+        with open(other_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(self.rows[:1])
+            writer.writerow(["Other", "Placement C", "Site", "300x250", "500", "$5.00", "$10.00", "2018-07-01", "2018-07-31"])
+
+        plans = tools.load_media_plans(self.folder.name)
+
+        self.assertEqual(len(plans), 5)
+        self.assertEqual(list(plans["Placement"]).count("Placement A"), 1)
+        self.assertEqual(plans.loc[plans["Placement"] == "Placement C", "Source File"].iloc[0],
+                         "Other Media Plan.csv")
+
+        pd.testing.assert_frame_equal(plans, tools.load_media_plans(self.folder.name))
+
+
+class DownloadWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def simulate_download(self, name, delay=0.2):
+        partial = os.path.join(self.folder.name, name + ".crdownload")
+
+        def download():
+            with open(partial, "w") as f:
+                f.write("Campaign,Placement\n")
+            time.sleep(delay)
+            with open(partial, "a") as f:
+                f.write("A,B\n")
+            os.rename(partial, os.path.join(self.folder.name, name))
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        return thread
+
+    def wait_for_plan(self, **kws):
+        return wait_for_download(self.folder.name, lambda name: "Media Plan" in name,
+                                 since=snapshot(self.folder.name), timeout=5,
+                                 poll_interval=0.05, settle_time=0.1, **kws)
+
+    def test_waits_for_partial_download_to_finish(self):
+        thread = self.simulate_download("ABC Media Plan.csv")
+        path = self.wait_for_plan(use_events=False)
+        thread.join()
+
+        self.assertEqual(os.path.basename(path), "ABC Media Plan.csv")
+        with open(path) as f:
+            self.assertEqual(f.read(), "Campaign,Placement\nA,B\n")
+
+    def test_waits_with_file_system_events(self):
+        thread = self.simulate_download("ABC Media Plan.csv")
+        path = self.wait_for_plan(use_events=True)
+        thread.join()
+
+        self.assertEqual(os.path.basename(path), "ABC Media Plan.csv")
+
+    def test_ignores_existing_files(self):
+        with open(os.path.join(self.folder.name, "Old Media Plan.csv"), "w") as f:
+            f.write("old")
+
+        with self.assertRaises(TimeoutError):
+            wait_for_download(self.folder.name, lambda name: "Media Plan" in name,
+                              since=snapshot(self.folder.name), timeout=0.3,
+                              poll_interval=0.05, use_events=False)
+
+
+class SpreadsheetWriterTests(unittest.TestCase):
+
+    test_df = pd.DataFrame({'Placement': ['A', 'B', None],
+                            'Planned Units': [1000.0, float('nan'), 500.0]})
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "report.xlsx")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_cell_position(self):
+        self.assertEqual(tools.writers.cell_position("$A$1"), (1, 1))
+        self.assertEqual(tools.writers.cell_position("AB12"), (12, 28))
+
+        with self.assertRaises(ValueError):
+            tools.writers.cell_position("12A")
+
+    def read_sheet(self, sheet="Raw Data"):
+        import openpyxl
+        return [list(row) for row in openpyxl.load_workbook(self.path)[sheet].values]
+
+    def test_openpyxl_new_and_existing_workbook(self):
+        tools.write_to_spreadsheet(self.test_df.copy(), self.path, "Raw Data", engine='openpyxl')
+
+        self.assertEqual(self.read_sheet(), [['Index', 'Placement', 'Planned Units'],
+                                             [0, 'A', 1000],
+                                             [1, 'B', None],
+                                             [2, None, 500]])
+
+        tools.write_to_spreadsheet(self.test_df.iloc[:1].copy(), self.path, "Raw Data",
+                                   cellref="$B$1", engine='openpyxl')
+
+        self.assertEqual(self.read_sheet()[:2], [[None, 'Index', 'Placement', 'Planned Units'],
+                                                 [None, 0, 'A', 1000]])
+
+    def test_xlsxwriter_writes_in_chunks(self):
+        tools.write_to_spreadsheet(self.test_df.copy(), self.path, "Raw Data",
+                                   engine='xlsxwriter', chunk_size=2)
+
+        self.assertEqual(self.read_sheet()[1:], [[0, 'A', 1000], [1, 'B', None], [2, None, 500]])
+
+    def test_unknown_options_are_rejected(self):
+        with self.assertRaises(TypeError):
+            tools.write_to_spreadsheet(self.test_df.copy(), self.path, "Raw Data", engine='openpyxl', range="A$1")
+
+        with self.assertRaises(TypeError):
+            tools.write_to_spreadsheet(self.test_df.copy(), self.path, "Raw Data", engine='xlsxwriter', chunksize=2)
+
+        with self.assertRaises(TypeError):
+            tools.write_to_spreadsheet(self.test_df.copy(), self.path, "Raw Data", engine='openpyxl', template=None)
+
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            tools.write_to_spreadsheet(self.test_df.copy(), self.path, "Raw Data", engine='csv')
+
+
+class PacingTests(unittest.TestCase):
+
+    test_df = pd.DataFrame({'Placement Start Date': pd.to_datetime(['2018-07-01', '2018-05-15', '2018-06-10', '2018-07-20']),
+                            'Placement End Date': pd.to_datetime(['2018-07-31', '2018-07-10', '2018-09-30', '2018-08-19']),
+                            'Planned Units': [1000.0, 3000.0, 11200.0, 5000.0]})
+
+    def test_monthly_commitment(self):
+        results = tools.monthly_commitment(self.test_df, pd.Timestamp('2018-07-31'), today=datetime(2018, 8, 1))
+
+        # Same month, ended before the end of the month, and two still running
+        self.assertEqual(list(results), [1000.0, round(9 / 31 * 3000, 0),
+                                         round(21 / 112 * 11200, 0), round(11 / 30 * 5000, 0)])
+
+
+class FakeDCMTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = api.fake.FakeDCM(file_size=50000)
+        self.server.add_profile(1)
+        self.server.add_report(1, 10)
+        api.set_service_factory(self.server.service_factory)
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.index_folder = tempfile.TemporaryDirectory()
+        api.set_file_index(os.path.join(self.index_folder.name, "file_index.sqlite"))
+
+    def tearDown(self):
+        api.set_service_factory(None)
+        api.set_file_index(None)
+        self.folder.cleanup()
+        self.index_folder.cleanup()
+
+    def test_run_and_download_report(self):
+        path = api.run_and_download_report(1, 10, path=os.path.join(self.folder.name, "report.csv"),
+                                           check_interval=0.01)
+
+        df = tools.load_from_csv(path)
+
+        self.assertEqual(list(df.columns), ["Date", "Placement ID", "Impressions"])
+        self.assertGreater(len(df), 0)
+        self.assertEqual(self.server.calls["reports.run"], 1)
+
+    def test_reports_run_concurrently(self):
+        durations = {11: 0.8, 12: 0.2, 13: 0.6, 14: 0.4}
+        for report_id, duration in durations.items():
+            self.server.add_report(1, report_id, run_duration=duration)
+
+        jobs = [(1, report_id, os.path.join(self.folder.name, f"report_{report_id}.csv")) for report_id in durations]
+
+        start = time.perf_counter()
+        paths = api.run_and_download_reports(jobs, check_interval=0.02, backoff=1, jitter=0)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(paths, [path for _, _, path in jobs])
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.assertGreaterEqual(elapsed, max(durations.values()))
+        self.assertLess(elapsed, max(durations.values()) + 0.5)
+
+    def test_wait_for_file_times_out(self):
+        self.server.run_duration = 60
+        report = api.Report(1, 10)
+        file_id = report.run()
+
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            report.wait_for_file(file_id, check_interval=0.01, backoff=1, jitter=0, timeout=0.1)
+
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_wait_for_failed_file(self):
+        report = api.Report(1, 10)
+        file_id = report.run()
+        self.server.files["10"][-1]["status"] = "FAILED"
+
+        with self.assertRaises(RuntimeError):
+            report.wait_for_file(file_id, check_interval=0.01)
+
+        self.assertEqual(self.server.calls["reports.files.get"], 1)
+
+    def test_wait_for_file_retries_transient_errors(self):
+        report = api.Report(1, 10)
+        file_id = report.run()
+
+        get_file = self.server.get_file
+        failures = iter([api.fake._http_error(503, "backendError", "Backend Error"),
+                         api.fake._http_error(403, "userRateLimitExceeded", "User Rate Limit Exceeded")])
+
+        def flaky_get_file(*args):
+            error = next(failures, None)
+            if error is not None:
+                raise error
+            return get_file(*args)
+
+        with mock.patch.object(self.server, "get_file", side_effect=flaky_get_file), \
+                mock.patch("api.api.retry_interval", 0.01):
+            file = report.wait_for_file(file_id, check_interval=0.01)
+
+        self.assertEqual(file["status"], "REPORT_AVAILABLE")
+        self.assertEqual(self.server.calls["reports.files.get"], 3)
+
+        # Other errors are not retried
+        with self.assertRaises(errors.HttpError) as raised:
+            report.wait_for_file("999", check_interval=0.01)
+
+        self.assertEqual(raised.exception.resp.status, 404)
+        self.assertEqual(self.server.calls["reports.files.get"], 4)
+
+    def test_ranged_download_matches_file(self):
+        report = api.Report(1, 10)
+        file_id = report.run()
+        path = os.path.join(self.folder.name, "report.csv")
+
+        report.download_file(file_id, path, chunk_size=7000)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.server.file_content(10, file_id))
+        self.assertEqual(self.server.calls["files.get_media"], 8)
+
+    def test_download_ignores_partial_of_another_file(self):
+        report = api.Report(1, 10)
+        old_id, new_id = report.run(), report.run()
+        path = os.path.join(self.folder.name, "report.csv")
+
+        old_content = self.server.file_content(10, old_id)
+        new_content = self.server.file_content(10, new_id)
+
+        # Left behind by an interrupted download of the old file
+        with open(f"{path}.{old_id}.part", "wb") as f:
+            f.write(old_content)
+
+        # And an interrupted download of the new one, which is resumed
+        with open(f"{path}.{new_id}.part", "wb") as f:
+            f.write(new_content[:8000])
+
+        report.download_file(new_id, path, chunk_size=100000)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), new_content)
+        self.assertEqual(self.server.calls["files.get_media"], 1)
+
+    def test_set_dimensions_reads_standard_dimensions_once(self):
+        for report_id in range(11, 30):
+            self.server.add_report(1, report_id)
+
+        api.dimensions.get_dimension_index.cache_clear()
+
+        with mock.patch("builtins.open", wraps=open) as opened:
+            for report_id in range(10, 30):
+                api.Report(1, report_id).set_dimensions(["Placement", "Site (DCM)", "dfa:creative"])
+
+        paths = [call[0][0] for call in opened.call_args_list]
+        self.assertEqual(paths.count(api.dimensions.standard_dimensions_path), 1)
+        self.assertEqual(self.server.calls["reports.update"], 20)
+
+    def test_batch_update_sends_one_request(self):
+        report = api.Report(1, 10)
+
+        with report.batch_update():
+            report.set_format("CSV")
+            report.set_filename("weekly_report")
+            report.set_date_range(period="LAST_7_DAYS")
+            report.set_dimensions(["Placement", "Date"])
+
+        self.assertEqual(self.server.calls["reports.update"], 1)
+        self.assertEqual(report.body["fileName"], "weekly_report")
+        self.assertEqual(report.body["criteria"]["dateRange"]["relativeDateRange"], "LAST_7_DAYS")
+        self.assertEqual([d["name"] for d in report.body["criteria"]["dimensions"]], ["dfa:placement", "dfa:date"])
+
+    def test_batch_update_without_changes_sends_nothing(self):
+        report = api.Report(1, 10)
+
+        with report.batch_update():
+            report.set_format(report.body["format"])
+
+        self.assertEqual(self.server.calls.get("reports.update", 0), 0)
+
+    def test_batch_update_discards_changes_on_error(self):
+        report = api.Report(1, 10)
+        body = report.body
+
+        with self.assertRaises(RuntimeError):
+            with report.batch_update():
+                report.set_filename("weekly_report")
+                raise RuntimeError
+
+        self.assertEqual(self.server.calls.get("reports.update", 0), 0)
+        self.assertEqual(report.body, body)
+
+    def test_load_dcm_incremental_refetches_restatement_window(self):
+        report = api.Report(1, 10)
+        report.set_date_range("2018-07-01", "2018-07-20")
+
+        with mock.patch("tools.report_readers.dcm_report_path", self.folder.name):
+            first = tools.load_dcm(1, 10, incremental=True, restatement_days=3)
+
+            report.set_date_range("2018-07-01", "2018-07-25")
+            second = tools.load_dcm(1, 10, incremental=True, restatement_days=3)
+
+        # Only the new days and the last three stored days are run again
+        self.assertEqual([f["dateRange"] for f in self.server.files["10"]],
+                         [{"startDate": "2018-07-01", "endDate": "2018-07-20"},
+                          {"startDate": "2018-07-18", "endDate": "2018-07-25"}])
+        self.assertEqual(api.Report(1, 10).body["criteria"]["dateRange"],
+                         {"startDate": "2018-07-01", "endDate": "2018-07-25"})
+
+        first_days = pd.to_datetime(first["Date"])
+        second_days = pd.to_datetime(second["Date"])
+        self.assertEqual(list(second_days.drop_duplicates()), list(pd.date_range("2018-07-01", "2018-07-25")))
+
+        # The first load is in file order, later ones in date order
+        kept = first[first_days < "2018-07-18"].sort_values("Date", kind="mergesort").reset_index(drop=True)
+        pd.testing.assert_frame_equal(second[second_days < "2018-07-18"].reset_index(drop=True), kept)
+
+        restated = second.loc[second_days == "2018-07-18", "Placement ID"]
+        self.assertFalse(restated.isin(first.loc[first_days == "2018-07-18", "Placement ID"]).any())
+
+    def test_load_dcm_incremental_restores_date_range_on_failure(self):
+        report = api.Report(1, 10)
+        report.set_date_range("2018-07-01", "2018-07-20")
+
+        date_ranges = []
+
+        def fail(profileId, reportId, path=None):
+            date_ranges.append(api.Report(profileId, reportId).body["criteria"]["dateRange"])
+            raise RuntimeError("Report failed")
+
+        with mock.patch("tools.report_readers.dcm_report_path", self.folder.name):
+            tools.load_dcm(1, 10, incremental=True)
+            report.set_date_range("2018-07-01", "2018-07-25")
+
+            with mock.patch("api.run_and_download_report", side_effect=fail):
+                with self.assertRaises(RuntimeError):
+                    tools.load_dcm(1, 10, incremental=True, restatement_days=3)
+
+        self.assertEqual(date_ranges, [{"startDate": "2018-07-18", "endDate": "2018-07-25"}])
+        self.assertEqual(api.Report(1, 10).body["criteria"]["dateRange"],
+                         {"startDate": "2018-07-01", "endDate": "2018-07-25"})
+
+    def interrupted_download(self, report, file_id, path, **kws):
+        def interrupt(offset, total):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            report.download_file(file_id, path, chunk_size=7000, progress=interrupt, **kws)
+
+    def test_compressed_download_resumes_as_plain(self):
+        report = api.Report(1, 10)
+        file_id = report.run()
+        path = os.path.join(self.folder.name, "report.csv")
+
+        self.interrupted_download(report, file_id, path, compress=True)
+        report.download_file(file_id, path, chunk_size=7000)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.server.file_content(10, file_id))
+        self.assertEqual(self.server.calls["files.get_media"], 8)
+
+    def test_plain_download_resumes_compressed(self):
+        report = api.Report(1, 10)
+        file_id = report.run()
+        path = os.path.join(self.folder.name, "report.csv.gz")
+
+        self.interrupted_download(report, file_id, path)
+        report.download_file(file_id, path, chunk_size=7000, compress=True)
+
+        with gzip.open(path, "rb") as f:
+            self.assertEqual(f.read(), self.server.file_content(10, file_id))
+        self.assertEqual(self.server.calls["files.get_media"], 8)
+        self.assertEqual(os.listdir(self.folder.name), ["report.csv.gz"])
+
+    def test_files_are_listed_in_pages(self):
+        report = api.Report(1, 10)
+        file_ids = [report.run() for _ in range(5)]
+
+        self.assertEqual(sorted(f["id"] for f in report.iter_files(page_size=2)), sorted(file_ids))
+        self.assertEqual(self.server.calls["reports.files.list"], 3)
+
+    def test_file_index_syncs_new_pages_only(self):
+        self.server.page_size = 2
+        report = api.Report(1, 10)
+        file_ids = [report.run() for _ in range(5)]
+
+        self.assertEqual(sorted(f["id"] for f in report.sync_file_index()), sorted(file_ids))
+        self.assertEqual(self.server.calls["reports.files.list"], 3)
+
+        self.assertEqual(report.sync_file_index(), [])
+        self.assertEqual(self.server.calls["reports.files.list"], 4)
+
+        time.sleep(0.01)  # Modified after every indexed file
+        new_id = report.run()
+        files = report.get_available_files(get_all=False)
+
+        self.assertEqual(self.server.calls["reports.files.list"], 5)
+        self.assertEqual(sorted(f["id"] for f in files), sorted(file_ids + [new_id]))
+        self.assertEqual(files, sorted(files, key=lambda f: int(f["lastModifiedTime"])))
+
+    def test_download_latest_file_skips_processing_files(self):
+        report = api.Report(1, 10)
+        available_id = report.run()
+
+        self.server.run_duration = 60
+        processing_id = report.run()
+
+        path = os.path.join(self.folder.name, "report.csv")
+        report.download_latest_file(path)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.server.file_content(10, available_id))
+
+        index = api.file_index.get_file_index()
+        self.assertEqual(index.latest(10)["id"], available_id)
+        self.assertEqual(index.get(10, processing_id)["status"], "PROCESSING")
+
+    def test_profiles_are_listed_once_per_ttl(self):
+        for _ in range(3):
+            api.Profile(1)
+            self.assertTrue(api.is_valid_user(1))
+
+        self.assertEqual(self.server.calls["userProfiles.list"], 1)
+
+        api.get_profiles(refresh=True)
+        self.assertEqual(self.server.calls["userProfiles.list"], 2)
+
+        api.invalidate_profile_cache()
+        api.is_valid_user(1)
+        self.assertEqual(self.server.calls["userProfiles.list"], 3)
+
+        with mock.patch("api.api.profile_cache_ttl", 0.01):
+            api.is_valid_user(1)
+            time.sleep(0.02)
+            api.is_valid_user(1)
+
+        self.assertEqual(self.server.calls["userProfiles.list"], 5)
+
+    def test_services_are_shared_per_thread(self):
+        factory = mock.Mock(wraps=self.server.service_factory)
+        api.set_service_factory(factory)
+
+        api.Profile(1)
+        report = api.Report(1, 10)
+        api.Report(1, 10)
+        self.assertIs(report._service, api.create_service())
+        self.assertEqual(factory.call_count, 1)
+
+        services = []
+        thread = threading.Thread(target=lambda: services.append(weakref.ref(api.create_service())))
+        thread.start()
+        thread.join()
+        gc.collect()
+
+        self.assertEqual(factory.call_count, 2)
+        self.assertIsNone(services[0]())
+
+    def test_quota_errors(self):
+        self.server.error_rate = 1
+
+        with self.assertRaises(errors.HttpError) as raised:
+            api.Report(1, 10)
+
+        self.assertEqual(raised.exception.resp.status, 403)
+
+
+class InstrumentationTests(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.disable()
+
+    def test_spans_nest_and_collect_counters(self):
+        with instrumentation.record(memory=True) as recorder:
+            with instrumentation.span("outer"):
+                instrumentation.count("api_calls")
+                with instrumentation.span("inner"):
+                    instrumentation.count("rows_parsed", 10)
+                    data = [0] * 100000
+
+        outer, inner = recorder.spans
+        self.assertEqual(inner.path, "outer/inner")
+        self.assertEqual(inner.depth, 1)
+        self.assertEqual(outer.counters, {"api_calls": 1})
+        self.assertEqual(inner.counters, {"rows_parsed": 10})
+        self.assertEqual(recorder.counters, {"api_calls": 1, "rows_parsed": 10})
+        self.assertGreaterEqual(outer.duration, inner.duration)
+        self.assertGreaterEqual(outer.peak_memory, inner.peak_memory)
+        self.assertGreater(inner.peak_memory, 0)
+
+    def test_traced_functions_report_rows_parsed(self):
+        lines = ["Report Fields", "Placement ID,Impressions", "123456789,100", "Grand Total:,100"]
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "report.csv")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+            tools.load_from_csv(path)
+
+            with instrumentation.record() as recorder:
+                tools.load_from_csv(path)
+
+            recorder.write_csv(os.path.join(folder, "timings.csv"))
+            with open(os.path.join(folder, "timings.csv")) as f:
+                rows = list(csv.DictReader(f))
+
+        self.assertEqual([row["name"] for row in rows], ["load_from_csv"])
+        self.assertEqual(rows[0]["rows_parsed"], "1")
+        self.assertIsNone(instrumentation._recorder)
+
+
+class StartupTests(unittest.TestCase):
+
+    def test_imports_load_nothing_heavy(self):
+        script = ("import sys, api, tools; "
+                  "print(sorted(m for m in ['pandas', 'selenium', 'googleapiclient', 'xlwings'] if m in sys.modules))")
+
+        output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                check=True, stdout=subprocess.PIPE).stdout
+
+        self.assertEqual(output.decode().strip(), "[]")
+
+
 class MiscellaneousTests(unittest.TestCase):
 
     period_map = pd.DataFrame([
@@ -174,6 +976,42 @@ class MiscellaneousTests(unittest.TestCase):
             self.assertEqual(p[1], self.get_period_from_daterange(p[0]))
             self.assertEqual(p[1], self.get_period_from_daterange(p[0]))
 
+    def test_period_map_assign_matches_mask_lookup(self):
+        dates = pd.Series(pd.to_datetime(["2018-09-19", "2018-10-19", "2018-11-04", "2018-10-07",
+                                          "2019-03-31", "2019-04-01", None]))
+
+        results = tools.assign_periods(dates, self.period_map)
+
+        self.assertEqual(list(results[:5]), [self.get_period_from_daterange(d) for d in dates[:5]])
+        self.assertTrue(results[5:].isna().all())
+
+    def test_period_map_gaps_and_overlaps(self):
+        period_map = self.period_map.drop(2).copy()
+        period_map.loc[0, 'end'] = pd.Timestamp('2018-10-10')
+        periods = tools.PeriodMap(period_map)
+
+        gaps = periods.gaps()
+        self.assertEqual(list(gaps['start']), [pd.Timestamp('2018-11-05')])
+        self.assertEqual(list(gaps['end']), [pd.Timestamp('2018-12-02')])
+
+        overlaps = periods.overlaps()
+        self.assertEqual(list(overlaps['period']), ['Sept 17 - Oct 7'])
+
+        with self.assertRaises(ValueError):
+            periods.assign(pd.Series([pd.Timestamp('2018-10-09')]))
+
+    def test_period_map_nested_periods(self):
+        period_map = pd.DataFrame({"start": pd.to_datetime(["2018-01-01", "2018-01-02", "2018-01-05", "2018-01-12"]),
+                                   "end": pd.to_datetime(["2018-01-10", "2018-01-03", "2018-01-06", "2018-01-15"]),
+                                   "period": ["A", "B", "C", "D"]})
+        periods = tools.PeriodMap(period_map)
+
+        self.assertEqual(list(periods.gaps()["start"]), [pd.Timestamp("2018-01-11")])
+        self.assertEqual(list(periods.gaps()["after_period"]), ["A"])
+
+        overlaps = periods.overlaps()
+        self.assertEqual(list(zip(overlaps["period"], overlaps["next_period"])), [("A", "B"), ("A", "C")])
+
 
 if __name__ == '__main__':
     unittest.main()
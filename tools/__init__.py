@@ -1,3 +1,50 @@
-from .report_readers import parse_datestr, redistribute_units, load_dcm, merge_with_prisma, write_to_spreadsheet, load_from_csv
-from .programmatic import merge_with_programmatic_report
-from .prisma import MediaPlan, get_media_plan_files
+"""
+Functions for reading, combining and writing DCM, Prisma and programmatic
+reports with pandas.
+
+The public names below are imported from their submodules on first use, so
+`import tools` stays cheap and only the dependencies of what is actually used
+(pandas, selenium, the api package...) get loaded.
+"""
+
+import importlib
+
+
+_exports = {
+    'parse_datestr': 'report_readers',
+    'redistribute_units': 'report_readers',
+    'load_dcm': 'report_readers',
+    'merge_with_prisma': 'report_readers',
+    'write_to_spreadsheet': 'report_readers',
+    'load_from_csv': 'report_readers',
+    'load_cached_csv': 'report_readers',
+    'merge_with_programmatic_report': 'programmatic',
+    'MediaPlan': 'prisma',
+    'get_media_plan_files': 'prisma',
+    'load_media_plans': 'prisma',
+    'monthly_commitment': 'pacing',
+    'PeriodMap': 'periods',
+    'assign_periods': 'periods',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(f'.{_exports[name]}', __name__), name)
+    else:
+        # Submodules, e.g. tools.prisma
+        try:
+            value = importlib.import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+            raise AttributeError(f"module '{__name__}' has no attribute '{name}'") from None
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,170 @@
+# cache.py
+"""
+Columnar on-disk cache for DataFrames parsed from report files.
+
+Each entry is stored as a Parquet file plus a small JSON file holding the
+source file's size, mtime and content hash, and any metadata that has to
+survive the round trip (e.g. the date_generated and date_range attributes
+set by load_from_csv).
+"""
+
+import glob
+import hashlib
+import json
+import os
+import warnings
+
+import pandas as pd
+
+
+default_max_size = 1024 ** 3  # 1 GB
+
+
+def file_digest(path, chunk_size=1024 ** 2):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FrameCache(object):
+    """
+    Cache of parsed DataFrames, keyed by a namespace (e.g. a report id), the
+    source file's mtime and size, and its content hash.
+
+    A lookup first matches on mtime and size so warm loads never have to read
+    the source file. Only when those have changed is the file hashed, so a
+    re-downloaded file with identical content is still a hit.
+
+    The least recently used entries are evicted whenever the cache directory
+    grows beyond max_size bytes.
+    """
+
+    def __init__(self, path, max_size=default_max_size):
+        self.path = path
+        self.max_size = max_size
+
+        # (source, mtime_ns, size) -> digest, so a miss followed by a put
+        # only reads the source file once
+        self._digests = {}
+
+    def _digest(self, source_path, stat):
+        key = (os.path.abspath(source_path), stat.st_mtime_ns, stat.st_size)
+        if key not in self._digests:
+            self._digests[key] = file_digest(source_path)
+        return self._digests[key]
+
+    def _entry_path(self, namespace, digest, ext):
+        return os.path.join(self.path, f"{namespace}_{digest}.{ext}")
+
+    def _entries(self, namespace):
+        pattern = os.path.join(glob.escape(self.path), f"{glob.escape(str(namespace))}_*.json")
+        for meta_path in glob.glob(pattern):
+            try:
+                with open(meta_path, "r") as f:
+                    yield meta_path, json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def get(self, source_path, namespace):
+        """Return (df, metadata) for source_path, or None on a cache miss"""
+
+        if not os.path.isdir(self.path):
+            return None
+
+        stat = os.stat(source_path)
+        source = os.path.abspath(source_path)
+
+        for meta_path, meta in self._entries(namespace):
+            if (meta["source"], meta["mtime_ns"], meta["size"]) == (source, stat.st_mtime_ns, stat.st_size):
+                return self._read(meta_path, meta)
+
+        digest = self._digest(source_path, stat)
+        meta_path = self._entry_path(namespace, digest, "json")
+        if not os.path.isfile(meta_path):
+            return None
+
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+
+        # Same content under a new mtime, remember it so the next lookup is fast
+        meta.update(source=source, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+        return self._read(meta_path, meta)
+
+    def _read(self, meta_path, meta):
+        data_path = meta_path[:-len("json")] + "parquet"
+
+        try:
+            df = pd.read_parquet(data_path)
+        except (OSError, ImportError):
+            return None
+
+        # Mark as recently used for eviction
+        os.utime(meta_path)
+
+        return df, meta["metadata"]
+
+    def put(self, source_path, namespace, df, metadata=None):
+
+        stat = os.stat(source_path)
+        digest = self._digest(source_path, stat)
+
+        os.makedirs(self.path, exist_ok=True)
+
+        for meta_path, meta in self._entries(namespace):
+            if meta["source"] == os.path.abspath(source_path):
+                self._remove(meta_path)
+
+        data_path = self._entry_path(namespace, digest, "parquet")
+        try:
+            # A default index, as pandas 0.23 passes no index option to the engine
+            df.reset_index(drop=True).to_parquet(data_path)
+        except (ImportError, TypeError, ValueError) as e:
+            # No Parquet engine, or columns Parquet can't store (e.g. mixed types)
+            warnings.warn(f"Unable to cache {source_path}: {e}")
+            if os.path.isfile(data_path):
+                os.remove(data_path)
+            return
+
+        meta = {"source": os.path.abspath(source_path),
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "sha1": digest,
+                "metadata": metadata or {}}
+
+        with open(self._entry_path(namespace, digest, "json"), "w") as f:
+            json.dump(meta, f)
+
+        self.evict()
+
+    def _remove(self, meta_path):
+        for path in [meta_path, meta_path[:-len("json")] + "parquet"]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size"""
+
+        entries = []
+        total = 0
+        for meta_path in glob.glob(os.path.join(glob.escape(self.path), "*.json")):
+            data_path = meta_path[:-len("json")] + "parquet"
+            size = os.path.getsize(meta_path)
+            if os.path.isfile(data_path):
+                size += os.path.getsize(data_path)
+            entries.append((os.path.getmtime(meta_path), size, meta_path))
+            total += size
+
+        for _, size, meta_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(meta_path)
+            total -= size
+
+    def clear(self):
+        for meta_path in glob.glob(os.path.join(glob.escape(self.path), "*.json")):
+            self._remove(meta_path)
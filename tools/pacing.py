@@ -0,0 +1,45 @@
+# pacing.py
+import calendar
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+def monthly_commitment(df, end_of_month, today=None, units_column='Planned Units',
+                       start_column='Placement Start Date', end_column='Placement End Date'):
+    """
+    Units each placement is committed to deliver in the reporting month ending
+    on end_of_month, computed for all rows at once.
+
+    args:
+    - df: DataFrame with planned units and placement start and end dates
+    - end_of_month: last day of the reporting period
+    - today: used for the number of days in the reporting month. Defaults to
+    today's date
+
+    Placements starting and ending in the same month commit all their units.
+    Placements that ended before end_of_month commit the share of units for
+    the days elapsed in their last month. Others commit the share of their
+    flight elapsed by end_of_month. Results are rounded to whole units.
+    """
+
+    today = datetime.today() if today is None else today
+    end_of_month = pd.Timestamp(end_of_month)
+
+    start = pd.to_datetime(df[start_column])
+    end = pd.to_datetime(df[end_column])
+
+    same_month = start.dt.month == end.dt.month
+    ended = end < end_of_month
+
+    # Whole days from the first of the end month, over the days in that month
+    ended_ratio = (end.dt.day - 1) / end.dt.days_in_month
+
+    days_in_month = calendar.monthrange(today.year, end_of_month.month)[1]
+    elapsed = np.minimum(end_of_month.day - start.dt.day, days_in_month)
+    ongoing_ratio = elapsed / (end - start).dt.days
+
+    ratio = np.select([same_month, ended], [1, ended_ratio], ongoing_ratio)
+
+    return (df[units_column] * ratio).round(0)
@@ -0,0 +1,94 @@
+# periods.py
+import numpy as np
+import pandas as pd
+
+
+def to_datetime64(values):
+    return np.asarray(pd.to_datetime(values), dtype='datetime64[ns]')
+
+
+class PeriodMap(object):
+    """
+    Sorted index over a table of reporting periods (e.g. broadcast or fiscal
+    months), used to tag dates with the period they fall in.
+
+    args:
+    - period_map: DataFrame with one row per period
+    - start, end: columns holding the first and last day of each period (inclusive)
+    - period: column holding the period label
+
+    Dates are assigned with a binary search over the sorted period starts, so
+    tagging n dates against k periods costs O(n log k).
+    """
+
+    def __init__(self, period_map, start='start', end='end', period='period'):
+        periods = period_map.sort_values(start).reset_index(drop=True)
+
+        self.periods = periods
+        self.starts = to_datetime64(periods[start])
+        self.ends = to_datetime64(periods[end])
+        self.labels = periods[period].values
+
+        self.label_codes, self.categories = pd.factorize(self.labels)
+
+        # Latest end among each period and those starting before it, and the
+        # period it belongs to, so nested periods are accounted for
+        self.reach = np.maximum.accumulate(self.ends)
+        positions = np.arange(len(self.ends))
+        self.reach_period = np.maximum.accumulate(np.where(self.ends == self.reach, positions, 0))
+
+    def overlaps(self):
+        """
+        Periods starting before an earlier period has ended, each paired with
+        the earlier period that runs the longest
+        """
+
+        overlapping = np.flatnonzero(self.starts[1:] <= self.reach[:-1])
+        earlier = self.reach_period[overlapping]
+
+        return pd.DataFrame({'period': self.labels[earlier],
+                             'next_period': self.labels[overlapping + 1],
+                             'start': self.starts[overlapping + 1],
+                             'end': np.minimum(self.ends[earlier], self.ends[overlapping + 1])})
+
+    def gaps(self, resolution=pd.Timedelta(days=1)):
+        """
+        Ranges of dates between the first and last period that no period covers.
+        resolution is the smallest step between two dates, one day by default.
+        """
+
+        resolution = np.timedelta64(pd.Timedelta(resolution).value, 'ns')
+        gap_starts = self.reach[:-1] + resolution
+        gap_ends = self.starts[1:] - resolution
+
+        missing = np.flatnonzero(gap_starts <= gap_ends)
+
+        return pd.DataFrame({'start': gap_starts[missing], 'end': gap_ends[missing],
+                             'after_period': self.labels[self.reach_period[missing]]})
+
+    def assign(self, dates):
+        """
+        Period of every date, as a categorical Series aligned with dates. Dates
+        outside every period are left missing.
+        """
+
+        overlaps = self.overlaps()
+        if len(overlaps):
+            pairs = ", ".join(f"'{a}' and '{b}'" for a, b in zip(overlaps['period'], overlaps['next_period']))
+            raise ValueError(f"Overlapping periods: {pairs}")
+
+        index = dates.index if isinstance(dates, pd.Series) else None
+        values = to_datetime64(dates)
+
+        positions = np.searchsorted(self.starts, values, side='right') - 1
+        clipped = np.clip(positions, 0, None)
+
+        found = (positions >= 0) & (values <= self.ends[clipped])
+        codes = np.where(found, self.label_codes[clipped], -1)
+
+        return pd.Series(pd.Categorical.from_codes(codes, self.categories), index=index)
+
+
+def assign_periods(dates, period_map, **kws):
+    """Shortcut for PeriodMap(period_map, **kws).assign(dates)"""
+    return PeriodMap(period_map, **kws).assign(dates)
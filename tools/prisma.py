@@ -1,15 +1,29 @@
 import csv
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import os
 import re
+from types import SimpleNamespace
 
 
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-from selenium.common import exceptions
+import numpy as np
+import pandas as pd
 
-import time
+import instrumentation
+
+from .cache import FrameCache
+from .watcher import snapshot, wait_for_download
+
+
+plan_columns = ["Campaign", "Placement", "Planned Units", "Planned Cost", "Rate", "Placement Start Date", "Placement End Date"]
+
+
+def parse_currency(values):
+    """Vectorized to_float: strip thousands separators and dollar signs"""
+
+    values = pd.Series(values, dtype=object).str.replace(",", "", regex=False).str.replace("$", "", regex=False)
+    return values.astype(float).values
 
 
 class MediaPlan(object):
@@ -41,62 +55,128 @@ class MediaPlan(object):
     def get_parent_row(self, index):
         """Go up the list until you find a non-placement"""
 
-        if not self.is_placement_row(self.media_plan[index]):
-            return self.get_parent_row(index - 1)
-        else:
-            return index
+        # Wraps around to the end of the plan when there is no placement above index
+        for i in range(index, index - len(self.media_plan), -1):
+            if self.is_placement_row(self.media_plan[i]):
+                return i
+
+        raise ValueError(f"No placement rows found in {self.path}")
 
     def to_float(self, string_value):
         return float(string_value.replace(",", "").replace("$", ""))
 
+    def index_rows(self):
+        """
+        Work out which rows make up the plan in a single pass over the media plan.
+
+        Returns a list of (name_row, source_row, share) tuples in output order:
+        the placement name comes from name_row, every other value from source_row,
+        and units and cost are divided by share. Standalone placements come
+        first, then the children of each package, which split the package's
+        units and cost evenly.
+        """
+
+        placements = []
+        children = defaultdict(list)
+        orphans = []
+        parent = None
+
+        for index, row in enumerate(self.media_plan):
+            is_placement = self.is_placement_row(row)
+            is_package_placement = self.is_package_placement_row(row)
+
+            if is_placement:
+                parent = index
+
+            if not is_package_placement and not is_placement:
+                if parent is None:
+                    orphans.append(index)
+                else:
+                    children[self.media_plan[parent][self.name]].append(index)
+
+            elif is_placement and not is_package_placement:
+                placements.append((index, index, 1))
+
+        if orphans:
+            # Rows above the first placement belong to the last placement in the plan
+            if parent is None:
+                raise ValueError(f"No placement rows found in {self.path}")
+
+            parent_name = self.media_plan[parent][self.name]
+            packages = [(parent_name, orphans + children.pop(parent_name, []))]
+            packages.extend(children.items())
+            children = dict(packages)
+
+        self.packages = defaultdict(list)
+        for parent_name, indices in children.items():
+            self.packages[parent_name] = [self.media_plan[i] for i in indices]
+
+        # A package's values come from the first row that mentions its name
+        package_rows = {}
+        for index, row in enumerate(self.media_plan):
+            if len(package_rows) == len(children):
+                break
+
+            for value in row:
+                if value in children and value not in package_rows:
+                    package_rows[value] = index
+
+        for parent_name, indices in children.items():
+            for index in indices:
+                placements.append((index, package_rows[parent_name], len(indices)))
+
+        return placements
+
+    @instrumentation.traced('MediaPlan.parse')
     def parse(self):
 
         self.output = []
 
-        for index, row in enumerate(self.media_plan):
+        for name_index, source_index, share in self.index_rows():
+            name_row = self.media_plan[name_index]
+            row = self.media_plan[source_index]
+            self.output.append((row[self.campaign_name],
+                                name_row[self.name],
+                                self.to_float(row[self.units]) / share,
+                                self.to_float(row[self.cost]) / share,
+                                self.to_float(row[self.rate]),
+                                row[self.start_date],
+                                row[self.end_date]))
 
-            if not self.is_package_placement_row(row) and not self.is_placement_row(row):
-                parent_row = self.media_plan[self.get_parent_row(index)]
-                self.packages[parent_row[self.name]].append(row)
-
-            if self.is_placement_row(row) and not self.is_package_placement_row(row):
-                self.output.append((row[self.campaign_name],
-                                    row[self.name],
-                                    self.to_float(row[self.units]),
-                                    self.to_float(row[self.cost]),
-                                    self.to_float(row[self.rate]),
-                                    row[self.start_date],
-                                    row[self.end_date]))
-
-        for parent in self.packages:
-            for row in self.media_plan:
-                if parent in row:
-                    package_campaign_name = row[self.campaign_name]
-                    package_units = self.to_float(row[self.units])
-                    package_cost = self.to_float(row[self.cost])
-                    package_rate = self.to_float(row[self.rate])
-                    package_start = row[self.start_date]
-                    package_end = row[self.end_date]
-                    break
-
-            for child in self.packages[parent]:
-                child_campaign_name = package_campaign_name
-                child_units = package_units / len(self.packages[parent])
-                child_cost = package_cost / len(self.packages[parent])
-                child_rate = package_rate
-                child_start = package_start
-                child_end = package_end
-
-                self.output.append((child_campaign_name,
-                                    child[self.name],
-                                    child_units,
-                                    child_cost,
-                                    child_rate,
-                                    child_start,
-                                    child_end))
+        instrumentation.count('rows_parsed', len(self.output))
 
+        if self.packages:
             self.columns = ["Campaign", "Placement", "Planned Units", "Planned Cost", "Rate", "Placement Start Date", "Placement End Date"]
 
+    def to_frame(self):
+        """
+        The parsed plan as a DataFrame with typed columns, built straight from
+        the media plan rows instead of self.output: Units, Cost and Rate are
+        floats, start and end dates are datetimes, and Campaign and Placement
+        are categoricals.
+        """
+
+        rows = self.index_rows()
+
+        sources = [self.media_plan[source_row] for _, source_row, _ in rows]
+        shares = np.array([share for _, _, share in rows], dtype=float)
+
+        def column(index):
+            return pd.Series([row[index] for row in sources], dtype=object)
+
+        df = pd.DataFrame(index=pd.RangeIndex(len(rows)))
+
+        df["Campaign"] = column(self.campaign_name).astype("category")
+        df["Placement"] = pd.Series([self.media_plan[name_row][self.name] for name_row, _, _ in rows],
+                                    dtype=object).astype("category")
+        df["Planned Units"] = parse_currency(column(self.units)) / shares
+        df["Planned Cost"] = parse_currency(column(self.cost)) / shares
+        df["Rate"] = parse_currency(column(self.rate))
+        df["Placement Start Date"] = pd.to_datetime(column(self.start_date))
+        df["Placement End Date"] = pd.to_datetime(column(self.end_date))
+
+        return df
+
     def save(self, dest):
 
         with open(dest, "w", newline="\n") as f:
@@ -109,6 +189,10 @@ class MediaPlan(object):
         return f"MediaPlan(campaign_name='{self.media_plan[1][self.campaign_name]}')"
 
 
+def is_media_plan_file(name):
+    return "Media Plan" in name and ".csv" in name
+
+
 def get_media_plan_files(path):
 
     if not os.path.isdir(path):
@@ -117,56 +201,133 @@ def get_media_plan_files(path):
     files = next(os.walk(path))[2]
     output = []
     for file in files:
-        if "Media Plan" in file and ".csv" in file:
+        if is_media_plan_file(file):
             output.append(os.path.join(path, file))
 
     return output
 
 
-def delay(seconds=10):
-    def outer_wrapper(func):
-        def wrapper(*ars, **kws):
-            # print(f"Waiting {seconds} seconds")
-            time.sleep(seconds)
-            return func(*ars, **kws)
-        return wrapper
-    return outer_wrapper
+def load_plan_file(path):
+    return MediaPlan(path).to_frame()
+
+
+def load_media_plans(path, max_workers=None, use_cache=True):
+    """
+    Parse every media plan in a folder and combine them into one plan table,
+    with a 'Source File' column recording where each row came from. Rows that
+    appear in more than one plan are only kept once.
+
+    Plans are parsed in a process pool (on Windows, call this from under an
+    `if __name__ == '__main__':` guard). With use_cache, each parsed plan is
+    kept in a .cache folder inside path, so only new or changed plan files are
+    parsed again.
+    """
+
+    files = get_media_plan_files(path)
+    cache = FrameCache(os.path.join(path, '.cache'))
+
+    frames = {}
+    stale = []
+
+    for file in files:
+        cached = cache.get(file, 'plan') if use_cache else None
+
+        if cached is None:
+            stale.append(file)
+        else:
+            frames[file] = cached[0]
+
+    if len(stale) == 1 or max_workers == 1:
+        parsed = map(load_plan_file, stale)
+    elif stale:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            parsed = list(pool.map(load_plan_file, stale))
+    else:
+        parsed = []
+
+    for file, df in zip(stale, parsed):
+        frames[file] = df
+        if use_cache:
+            cache.put(file, 'plan', df)
+
+    if not frames:
+        return pd.DataFrame(columns=plan_columns + ['Source File'])
+
+    plans = pd.concat([frames[file].astype({'Campaign': object, 'Placement': object})
+                                   .assign(**{'Source File': os.path.basename(file)})
+                       for file in files], ignore_index=True)
+
+    plans = plans.drop_duplicates(subset=plan_columns).reset_index(drop=True)
+
+    for col in ['Campaign', 'Placement', 'Source File']:
+        plans[col] = plans[col].astype('category')
+
+    return plans
+
+
+@lru_cache(maxsize=None)
+def _selenium():
+    # Selenium is only loaded once a page is opened
+    from selenium import webdriver
+    from selenium.common import exceptions
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.support import expected_conditions
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    return SimpleNamespace(webdriver=webdriver, exceptions=exceptions, By=By, Keys=Keys,
+                           expected_conditions=expected_conditions, WebDriverWait=WebDriverWait)
 
 
 class PrismaWebPage(object):
 
-    def __init__(self, campaign_id, folder_path):
+    def __init__(self, campaign_id, folder_path, timeout=30):
+        self.selenium = selenium = _selenium()
+
         self.campaign_id = campaign_id
+        self.timeout = timeout
 
         self.url = f"https://omgca-prisma.mediaocean.com/campaign-management/#osAppId=prsm-cm-spa&osPspId=prsm-cm-buy&campaign-id={self.campaign_id.upper()}&route=online"
 
         destination = folder_path
 
-        chromeOptions = webdriver.ChromeOptions()
+        chromeOptions = selenium.webdriver.ChromeOptions()
         prefs = {"download.default_directory": destination}
         chromeOptions.add_experimental_option("prefs", prefs)
 
         # chromedriver = "path/to/chromedriver.exe"
         chromedriver = os.path.join(os.path.split(__file__)[0], 'chromedriver.exe')
 
-        self.driver = webdriver.Chrome(chrome_options=chromeOptions, executable_path=chromedriver)
-        self.driver.implicitly_wait(10)
+        # Lookups use explicit waits, see find_element
+        self.driver = selenium.webdriver.Chrome(chrome_options=chromeOptions, executable_path=chromedriver)
         # self.driver.set_window_size(1920, 1080)
         self.driver.maximize_window()
         self.driver.get(self.url)
 
-    def element_exists(self, by, element):
+    def element_exists(self, by, element, timeout=2):
+
         try:
-            self.find_element(by, element)
+            self.find_element(by, element, timeout=timeout)
             return True
-        except exceptions.NoSuchElementException:
+        except self.selenium.exceptions.NoSuchElementException:
             return False
 
-    @delay(5)
-    def find_element(self, by, lookup):
-        return self.driver.find_element(by, lookup)
+    def find_element(self, by, lookup, timeout=None):
+        """Wait up to timeout seconds (default self.timeout) for an element to be clickable"""
+
+        selenium = self.selenium
+
+        timeout = self.timeout if timeout is None else timeout
+        condition = selenium.expected_conditions.element_to_be_clickable((by, lookup))
+
+        try:
+            return selenium.WebDriverWait(self.driver, timeout).until(condition)
+        except selenium.exceptions.TimeoutException:
+            raise selenium.exceptions.NoSuchElementException(f"No clickable element with {by} '{lookup}' after {timeout}s")
 
     def old_buy_tab(self):
+        By, Keys = self.selenium.By, self.selenium.Keys
+
         if not self.element_exists(By.ID, "switch-to-plpb"):
             pass  # Already on old buy tab page
         else:
@@ -174,6 +335,7 @@ class PrismaWebPage(object):
             elem.send_keys(Keys.RETURN)
 
     def new_buy_tab(self):
+        By, Keys = self.selenium.By, self.selenium.Keys
 
         if not self.element_exists(By.ID, "switch-to-new-buy-tab"):
             pass  # Already on new buy tab page
@@ -182,10 +344,11 @@ class PrismaWebPage(object):
             elem.send_keys(Keys.RETURN)
 
     def export_media_plan(self):
+        By, Keys = self.selenium.By, self.selenium.Keys
 
         try:
             button = self.find_element(By.CLASS_NAME, "mi-export-import")
-        except exceptions.NoSuchElementException:
+        except self.selenium.exceptions.NoSuchElementException:
             self.new_buy_tab()
             button = self.find_element(By.CLASS_NAME, "mi-export-import")
 
@@ -198,23 +361,20 @@ class PrismaWebPage(object):
         self.driver.close()
 
 
-def plan_file_exists(campaign_id, folder_path):
-    plan_files = get_media_plan_files(folder_path)
-    if True in [campaign_id in plan for plan in plan_files]:
-        return True
-    else:
-        return False
+def download_plan(campaign_id, folder_path, timeout=600):
+    """Export a campaign's media plan from Prisma. Returns the path of the downloaded plan"""
 
+    before = snapshot(folder_path)
 
-def download_plan(campaign_id, folder_path, wait_time=5):
     plan = PrismaWebPage(campaign_id, folder_path)
-    plan.export_media_plan()
 
-    while True:
-        if plan_file_exists(campaign_id, folder_path):
-            return True
-        else:
-            time.sleep(wait_time)
+    try:
+        plan.export_media_plan()
+
+        return wait_for_download(folder_path, lambda name: is_media_plan_file(name) and campaign_id in name,
+                                 since=before, timeout=timeout)
+    finally:
+        plan.close()
 
 
 if __name__ == '__main__':
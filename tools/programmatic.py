@@ -1,18 +1,131 @@
 # programmatic.py
+import hashlib
+import itertools
+import os
+
 import pandas as pd
 
+import instrumentation
+
+from .cache import FrameCache
 from .report_readers import redistribute_units
 
 
-def find_matching_column(df, pattern):
-    result = [col for col in df.columns if set(df[col].astype(str).str.match(pattern)) == {True}]
+# (column names, pattern) -> column found by find_matching_column, so reports
+# sharing a template skip the detection
+_matching_columns = {}
+
+
+def column_matches(series, pattern):
+    return len(series) > 0 and series.astype(str).str.match(pattern, na=False).all()
+
+
+def find_matching_column(df, pattern, sample_size=100, use_cache=True):
+    """
+    Return the first column of df in which every value matches pattern.
+
+    Boolean, datetime and timedelta columns are skipped, and each column is
+    first checked on its first sample_size values, so most columns are
+    rejected without converting them in full. With use_cache, the result is
+    remembered for this set of column names and pattern.
+    """
+
+    key = (tuple(df.columns), pattern)
+    if use_cache and key in _matching_columns:
+        return _matching_columns[key]
+
+    for col in df.columns:
+        series = df[col]
+
+        if series.dtype.kind in 'bMm':
+            continue
+
+        if not column_matches(series.iloc[:sample_size], pattern):
+            continue
+
+        if len(series) <= sample_size or column_matches(series.iloc[sample_size:], pattern):
+            if use_cache:
+                _matching_columns[key] = col
+            return col
+
+    raise ValueError(f"No column matches '{pattern}'")
+
+
+def iter_sheet_rows(path, sheet_name):
+    """
+    Yield the rows of a sheet as lists of values, the header first. .xlsx and
+    .xlsm files are streamed with openpyxl in read-only mode, other workbooks
+    are read whole with pandas.
+    """
+
+    if not path.lower().endswith(('.xlsx', '.xlsm')):
+        df = pd.read_excel(path, sheet_name=sheet_name)
+        yield list(df.columns)
+        yield from df.values.tolist()
+        return
+
+    import openpyxl
+
+    book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in book[sheet_name].iter_rows():
+            values = [cell.value for cell in row]
+            if any(value is not None for value in values):
+                yield values
+    finally:
+        book.close()
+
+
+def read_programmatic_report(prog_filepath, prog_sheet_name, columns, pattern=r"^\d{9}$",
+                             sample_size=100, use_cache=True):
+    """
+    Read only the placement ID column (found with find_matching_column) and
+    the given columns from a programmatic report.
+
+    The sheet is read in a single pass: the placement ID column is found in
+    its first sample_size rows, and only the needed values are kept from
+    every row.
+
+    Returns the DataFrame and the name of the placement ID column. With
+    use_cache, the result is kept as Parquet in a .cache folder next to the
+    report, keyed by the file, sheet name and columns, so an unchanged
+    report is only parsed once.
+    """
+
+    key = hashlib.sha1(repr((prog_sheet_name, sorted(columns), pattern)).encode()).hexdigest()[:12]
+    namespace = f"prog-{key}"
+    cache = FrameCache(os.path.join(os.path.dirname(os.path.abspath(prog_filepath)), '.cache'))
 
-    if not result:
+    if use_cache:
+        cached = cache.get(prog_filepath, namespace)
+        if cached is not None:
+            df, metadata = cached
+            return df, metadata['placement_id_col']
+
+    rows = iter_sheet_rows(prog_filepath, prog_sheet_name)
+    header = [f"Unnamed: {i}" if name is None else name for i, name in enumerate(next(rows, []))]
+
+    sample = list(itertools.islice(rows, sample_size))
+    placement_id_col = find_matching_column(pd.DataFrame(sample, columns=header), pattern)
+
+    names = [placement_id_col] + [col for col in columns if col != placement_id_col and col in header]
+    positions = sorted(header.index(col) for col in names)
+
+    values = [[row[i] if i < len(row) else None for i in positions] for row in itertools.chain(sample, rows)]
+    df = pd.DataFrame(values, columns=[header[i] for i in positions])
+
+    if not column_matches(df[placement_id_col], pattern):
         raise ValueError(f"No column matches '{pattern}'")
-    else:
-        return result[0]
 
+    instrumentation.count('rows_parsed', len(df))
 
+    if use_cache:
+        cache.put(prog_filepath, namespace, df, {'placement_id_col': placement_id_col})
+
+    return df, placement_id_col
+
+
+@instrumentation.traced('merge_with_programmatic_report')
 def merge_with_programmatic_report(prog_filepath, prog_sheet_name, dcm_df, merge_on=['Placement ID'], merge_prog_columns=['Spend']):
     """
     Merge columns from a programmatic report with another report (presumably DCM)
@@ -33,7 +146,8 @@ def merge_with_programmatic_report(prog_filepath, prog_sheet_name, dcm_df, merge
         error_message = "The reports have to be merged on at least the Placement ID level."
         raise ValueError(error_message)
 
-    prog_df = pd.read_excel(prog_filepath, sheet_name=prog_sheet_name)
+    prog_columns = [col for col in merge_on if col != 'Placement ID'] + merge_prog_columns
+    prog_df, placement_id_col = read_programmatic_report(prog_filepath, prog_sheet_name, prog_columns)
 
     if 'Date' in prog_df:
         prog_df['Date'] = pd.to_datetime(prog_df['Date'])
@@ -41,8 +155,6 @@ def merge_with_programmatic_report(prog_filepath, prog_sheet_name, dcm_df, merge
     if 'Date' in dcm_df:
         dcm_df['Date'] = pd.to_datetime(dcm_df['Date'])
 
-    placement_id_col = find_matching_column(prog_df, r"^\d{9}$")
-
     dcm_df['Placement ID'] = dcm_df['Placement ID'].astype(int)
     prog_df[placement_id_col] = prog_df[placement_id_col].astype(int)
 
@@ -1,17 +1,21 @@
+import copy
 import csv
+from functools import lru_cache
 
 import os
 import pandas as pd
 from datetime import datetime
-import parsedatetime as pdt
-import xlwings as xw
 
-from .prisma import MediaPlan
+from .prisma import MediaPlan, load_media_plans
+from .cache import FrameCache
+from .store import PartitionStore
 from .config import dcm_report_path
-from api import run_and_download_report, Report
+from .writers import writers
 
 import warnings
 
+import instrumentation
+
 
 def get_files_in_folder(path):
     files = next(os.walk(path))[-1]
@@ -19,9 +23,14 @@ def get_files_in_folder(path):
     return files
 
 
+@lru_cache(maxsize=None)
+def _calendar():
+    import parsedatetime as pdt
+    return pdt.Calendar()
+
+
 def parse_datestr(datestr):
-    cal = pdt.Calendar()
-    return datetime(*cal.parse(datestr)[0][:6])
+    return datetime(*_calendar().parse(datestr)[0][:6])
 
 
 def redistribute_units(df, left_columns, right_column, weight_against='na'):
@@ -33,45 +42,117 @@ def redistribute_units(df, left_columns, right_column, weight_against='na'):
     a column evenly:
     Example:
     >>> df = DataFrame({'Col1': ['A', 'A', 'A', 'B', 'B'],
-                    'Col2': [1000, 1000, 1000, 1000, 1000]})
+                        'Col2': [1000, 1000, 1000, 2000, 2000],
+                        'Col3': [30, 30, 30, 4, 4]})
     >>> df
-      Col1  Col2
-    0    A  1000
-    1    A  1000
-    2    A  1000
-    3    B  2000
-    4    B  2000
+      Col1  Col2  Col3
+    0    A  1000    30
+    1    A  1000    30
+    2    A  1000    30
+    3    B  2000     4
+    4    B  2000     4
 
     >>> redistribute_units(df, ['Col1'], 'Col2')
-    >>>
     0     333.333333
     1     333.333333
     2     333.333333
     3    1000.000000
     4    1000.000000
-    dtype: float64
+    Name: Col2, dtype: float64
+
+    right_column can also be a list of columns, in which case all of them are
+    redistributed in a single grouping pass and a DataFrame is returned:
+    >>> redistribute_units(df, ['Col1'], ['Col2', 'Col3'])
+              Col2  Col3
+    0   333.333333  10.0
+    1   333.333333  10.0
+    2   333.333333  10.0
+    3  1000.000000   2.0
+    4  1000.000000   2.0
     """
 
+    if isinstance(left_columns, str):
+        left_columns = [left_columns]
+
+    grouped = df.groupby(left_columns)
+
     if weight_against == "na":
 
-        mapping = df.groupby(left_columns).count()
-        counts = df.apply(lambda row: mapping.loc[tuple(row[left_columns])][right_column], axis=1)
+        # Each value is split by the number of non-null values in its group
+        counts = grouped[right_column].transform('count')
         return df[right_column] / counts
 
     else:
 
-        sums = df.groupby(left_columns)[weight_against].sum()
-        weights = df.apply(lambda row: row[weight_against] / sums.loc[tuple(row[left_columns])], axis=1)
+        sums = grouped[weight_against].transform('sum')
+        weights = df[weight_against] / sums
+
+        if isinstance(right_column, str):
+            return df[right_column] * weights
+
+        return df[right_column].mul(weights, axis=0)
+
+
+class _BoundedReader(object):
+    """Read-only view of a binary file that stops at a fixed byte offset"""
+
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end
+
+    def read(self, size=-1):
+        remaining = self.end - self.f.tell()
+        if remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self.f.read(size)
+
+    def readline(self, size=-1):
+        remaining = self.end - self.f.tell()
+        if remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self.f.readline(size)
 
-        return df[right_column] * weights
+    def __iter__(self):
+        return iter(self.readline, b"")
 
 
+def find_footer_offset(f, footer=b"Grand Total", blocksize=65536):
+    """
+    Return the byte offset at which the trailing footer line of an open binary
+    file starts, or the file size if the last line is not a footer.
+    """
+
+    size = f.seek(0, os.SEEK_END)
+    start = max(size - blocksize, 0)
+    f.seek(start)
+    tail = f.read().rstrip(b"\r\n")
+
+    line_start = tail.rfind(b"\n") + 1
+    if tail[line_start:].startswith(footer):
+        return start + line_start
+
+    return size
+
+
+@instrumentation.traced('load_from_csv')
 def load_from_csv(path):
+    """
+    Load a DCM report saved as a CSV file. The metadata preamble is scanned
+    once to find the "Report Fields" header, and the data block is parsed from
+    that byte offset with the C engine, stopping before the "Grand Total" footer.
+    """
 
-    with open(path, "r") as f:
-        reader = csv.reader(f)
+    date_generated = None
+    date_range = None
 
-        for i, row in enumerate(reader, 1):
+    with open(path, "rb") as f:
+
+        for line in iter(f.readline, b""):
+            row = next(csv.reader([line.decode()]), [])
 
             if "Date/Time Generated" in row:
                 date_generated = pd.to_datetime(parse_datestr(row[1]))
@@ -82,10 +163,18 @@ def load_from_csv(path):
                 date_range = [pd.to_datetime(parse_datestr(x)) for x in date_range]
 
             if "Report Fields" in row:
-                skiprows = i
+                data_offset = f.tell()
                 break
 
-    df = pd.read_csv(path, skiprows=skiprows, skipfooter=1, engine='python')
+        else:
+            raise ValueError(f"{path} is not a DCM report: no 'Report Fields' section found")
+
+        footer_offset = find_footer_offset(f)
+        f.seek(data_offset)
+
+        df = pd.read_csv(_BoundedReader(f, footer_offset), engine='c')
+
+    instrumentation.count('rows_parsed', len(df))
 
     warnings.filterwarnings('ignore')
 
@@ -95,7 +184,68 @@ def load_from_csv(path):
     return df
 
 
-def load_dcm(profileId, reportId, path=None, force_run=False):
+# Stored days run again on every incremental refresh, for DCM's late data
+default_restatement_days = 3
+
+
+def _timestamp_to_str(value):
+    return None if value is None else value.isoformat()
+
+
+def _str_to_timestamp(value):
+    return None if value is None else pd.Timestamp(value)
+
+
+def _frame_metadata(df):
+    return {'date_generated': _timestamp_to_str(df.date_generated),
+            'date_range': None if df.date_range is None else [_timestamp_to_str(d) for d in df.date_range]}
+
+
+def _set_frame_metadata(df, metadata):
+    warnings.filterwarnings('ignore')
+
+    df.date_generated = _str_to_timestamp(metadata.get('date_generated'))
+    df.date_range = None if metadata.get('date_range') is None else [_str_to_timestamp(d) for d in metadata['date_range']]
+
+
+def load_cached_csv(path, namespace):
+    """
+    Same as load_from_csv, but keeps a Parquet copy of the parsed report in a
+    .cache folder next to the CSV, and reuses it for as long as the CSV is
+    unchanged.
+    """
+
+    cache = FrameCache(os.path.join(os.path.dirname(os.path.abspath(path)), '.cache'))
+
+    cached = cache.get(path, namespace)
+
+    if cached is None:
+        df = load_from_csv(path)
+        cache.put(path, namespace, df, _frame_metadata(df))
+
+        return df
+
+    df, metadata = cached
+    _set_frame_metadata(df, metadata)
+
+    return df
+
+
+def load_dcm(profileId, reportId, path=None, force_run=False, use_cache=True, incremental=False,
+             restatement_days=default_restatement_days):
+    """
+    Load a DCM report, running and downloading it first if there is no local
+    copy or force_run is set.
+
+    With incremental=True the rows are served from a date-partitioned store
+    instead, and only the days missing from it (plus the last restatement_days
+    stored days) are run and downloaded. See load_dcm_incremental.
+    """
+
+    from api import run_and_download_report, Report
+
+    if incremental:
+        return load_dcm_incremental(profileId, reportId, path=path, restatement_days=restatement_days)
 
     if path is None:
         path = os.path.join(dcm_report_path, Report(profileId, reportId).filename + '.csv')
@@ -103,12 +253,102 @@ def load_dcm(profileId, reportId, path=None, force_run=False):
     if not os.path.isfile(path) or force_run:
         run_and_download_report(profileId, reportId, path=path)
 
+    if use_cache:
+        return load_cached_csv(path, reportId)
+
     df = load_from_csv(path)
 
     return df
 
 
+def _report_date_range(report, store):
+    """First and last day covered by a report, as Timestamps"""
+
+    date_range = report.body['criteria']['dateRange']
+
+    if 'startDate' in date_range:
+        return pd.Timestamp(date_range['startDate']), pd.Timestamp(date_range['endDate'])
+
+    # Relative ranges (e.g. YEAR_TO_DATE) run up to today, from the start of
+    # the first full download
+    stored_range = store.metadata.get('date_range')
+    start = store.dates()[0] if stored_range is None else pd.Timestamp(stored_range[0])
+
+    return start, pd.Timestamp(datetime.today().date())
+
+
+def load_dcm_incremental(profileId, reportId, path=None, restatement_days=default_restatement_days):
+    """
+    Load a DCM report from a local date-partitioned store, downloading only
+    what changed since the last refresh.
+
+    The first call seeds the store from the report at path, running it if there
+    is no local copy. Later calls narrow the report's date range to the days
+    after the last stored day, plus the last restatement_days stored days to
+    pick up data DCM restates after the fact, run it, and upsert the result.
+    The report's original date range is restored afterwards.
+
+    The report must include the Date dimension. It is meant for cumulative
+    reports with a fixed start date.
+    """
+
+    from api import run_and_download_report, Report
+
+    report = Report(profileId, reportId)
+    store = PartitionStore(os.path.join(dcm_report_path, '.store', str(reportId)))
+
+    if path is None:
+        path = os.path.join(dcm_report_path, report.filename + '.csv')
+
+    if not store.dates():
+        ran = not os.path.isfile(path)
+        if ran:
+            run_and_download_report(profileId, reportId, path=path)
+
+        df = load_from_csv(path)
+        if store.date_column not in df.columns:
+            raise ValueError(f"Report {reportId} has no '{store.date_column}' column, it can't be loaded incrementally")
+
+        store.upsert(df)
+        store.metadata = _frame_metadata(df)
+
+        if ran:
+            return df
+
+    start, end = _report_date_range(report, store)
+    delta_start = max(start, store.dates()[-1] + pd.Timedelta(days=1 - restatement_days))
+
+    if delta_start <= end:
+        delta_path = os.path.splitext(path)[0] + '_delta.csv'
+        date_range = copy.deepcopy(report.body['criteria']['dateRange'])
+
+        report.set_date_range(f"{delta_start:%Y-%m-%d}", f"{end:%Y-%m-%d}")
+        try:
+            run_and_download_report(profileId, reportId, path=delta_path)
+        finally:
+            with report.update_request_body() as body:
+                body['criteria']['dateRange'] = date_range
+
+        delta = load_from_csv(delta_path)
+        os.remove(delta_path)
+
+        store.upsert(delta, delta_start, end)
+        store.metadata = {'date_generated': _timestamp_to_str(delta.date_generated),
+                          'date_range': [_timestamp_to_str(start), _timestamp_to_str(end)]}
+
+    df = store.load(start, end)
+    _set_frame_metadata(df, store.metadata)
+
+    return df
+
+
+@instrumentation.traced('merge_with_prisma')
 def merge_with_prisma(df, plan_path, join_on=None):
+    """
+    Add planned units, cost, rate and flight dates from a Prisma media plan.
+    plan_path can be a single plan, or a folder, in which case every media
+    plan in it is loaded with load_media_plans.
+    """
 
     if join_on is None:
         join_on = ["Campaign", "Placement"]
@@ -116,13 +356,10 @@ def merge_with_prisma(df, plan_path, join_on=None):
     elif "Placement" not in join_on:
         raise ValueError("Reports must be merged by at least the placement level")
 
-    plan = MediaPlan(plan_path)
-    plan.parse()
-
-    plan_df = pd.DataFrame(plan.output, columns=["Campaign", "Placement",
-                                                 "Planned Units", "Planned Cost",
-                                                 "Rate", "Placement Start Date",
-                                                 "Placement End Date"])
+    if os.path.isdir(plan_path):
+        plan_df = load_media_plans(plan_path).drop(columns=['Source File'])
+    else:
+        plan_df = MediaPlan(plan_path).to_frame()
 
     df.sort_values(['Site (DCM)', 'Placement'], inplace=True)
     df = df.merge(plan_df.drop_duplicates(), how="left", left_on=join_on,
@@ -131,15 +368,20 @@ def merge_with_prisma(df, plan_path, join_on=None):
     # df.fillna(0, inplace=True)
 
 
-def write_to_spreadsheet(df, book_path, sheet, cellref="$A$1", clear=True):
+@instrumentation.traced('write_to_spreadsheet')
+def write_to_spreadsheet(df, book_path, sheet, cellref="$A$1", clear=True, engine='xlwings', **kws):
+    """
+    Write df, with its index, into a sheet of an Excel workbook starting at cellref.
+
+    engine picks the backend from tools.writers.writers: 'xlwings' (needs
+    Excel), 'openpyxl' (new or existing workbooks, keeps .xlsm macros) or
+    'xlsxwriter' (new workbooks only, constant memory). Other keyword
+    arguments, such as chunk_size or template, are passed to the backend,
+    which raises TypeError for any it does not take.
+    """
+
+    if engine not in writers:
+        raise ValueError(f"Unknown engine '{engine}', must be one of {sorted(writers)}")
 
     df.index.name = "Index"
-    book = xw.Book(book_path)
-    sht = book.sheets(sheet)
-    if clear:
-        sht.clear_contents()
-
-    # rnge = sht.range(cellref)
-    # rnge.offset(1, 0).value = df.values
-    # rnge.values = list(df.columns)
-    sht.range(cellref).value = df
+    writers[engine](df, book_path, sheet, cellref=cellref, clear=clear, **kws)
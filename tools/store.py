@@ -0,0 +1,100 @@
+# store.py
+"""
+Date-partitioned store for the rows of a DCM report.
+
+Each day of data is kept in its own Parquet file, so refreshing a report only
+rewrites the days that were downloaded again. A metadata.json file next to the
+partitions holds anything that has to be served with the full frame (e.g. the
+report's date range and when it was generated).
+"""
+
+import glob
+import json
+import os
+
+import pandas as pd
+
+
+class PartitionStore(object):
+    """
+    Rows of a report, partitioned by the day in date_column.
+
+    upsert replaces whole days at a time: every day present in the new rows
+    overwrites the stored partition for that day.
+    """
+
+    def __init__(self, path, date_column='Date'):
+        self.path = path
+        self.date_column = date_column
+
+    def _partition_path(self, date):
+        return os.path.join(self.path, f"{date:%Y-%m-%d}.parquet")
+
+    def _partitions(self):
+        pattern = os.path.join(glob.escape(self.path), "????-??-??.parquet")
+        return {pd.Timestamp(os.path.basename(p)[:-len(".parquet")]): p for p in glob.glob(pattern)}
+
+    def dates(self):
+        """Sorted days held in the store"""
+        return sorted(self._partitions())
+
+    def upsert(self, df, start=None, end=None):
+        """
+        Write the rows of df, one partition per day. When start and end are
+        given, df is taken as the complete data for that range, and stored days
+        in the range that have no rows in df are removed.
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        days = pd.to_datetime(df[self.date_column]).dt.normalize()
+
+        if start is not None and end is not None:
+            present = set(days.unique())
+            for date, path in self._partitions().items():
+                if pd.Timestamp(start) <= date <= pd.Timestamp(end) and date not in present:
+                    os.remove(path)
+
+        for date, part in df.groupby(days):
+            path = self._partition_path(date)
+            # Write next to the partition and swap it in, so a failed write
+            # never leaves a day half-stored
+            part.reset_index(drop=True).to_parquet(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def load(self, start=None, end=None):
+        """All stored rows between start and end (inclusive), in date order"""
+
+        partitions = sorted(self._partitions().items())
+
+        if start is not None:
+            partitions = [(d, p) for d, p in partitions if d >= pd.Timestamp(start)]
+        if end is not None:
+            partitions = [(d, p) for d, p in partitions if d <= pd.Timestamp(end)]
+
+        if not partitions:
+            return pd.DataFrame()
+
+        return pd.concat([pd.read_parquet(p) for _, p in partitions], ignore_index=True)
+
+    @property
+    def metadata(self):
+        path = os.path.join(self.path, "metadata.json")
+        if not os.path.isfile(path):
+            return {}
+
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @metadata.setter
+    def metadata(self, value):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "metadata.json"), "w") as f:
+            json.dump(value, f)
+
+    def clear(self):
+        for path in self._partitions().values():
+            os.remove(path)
+
+        if os.path.isfile(os.path.join(self.path, "metadata.json")):
+            os.remove(os.path.join(self.path, "metadata.json"))
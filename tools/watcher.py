@@ -0,0 +1,121 @@
+# watcher.py
+"""
+Wait for browser downloads to finish in a folder.
+
+When watchdog is installed the folder is watched with the platform's native
+file system events (inotify on Linux), otherwise it is polled.
+"""
+
+import os
+import threading
+import time
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+partial_suffixes = ('.crdownload', '.part', '.tmp')
+
+
+def snapshot(folder):
+    """Size and modification time of every file in folder"""
+
+    output = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                output[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+    return output
+
+
+def is_partial(name):
+    return name.endswith(partial_suffixes)
+
+
+def _start_observer(folder, event):
+
+    if Observer is None:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, _):
+            event.set()
+
+    observer = Observer()
+    observer.schedule(Handler(), folder, recursive=False)
+    observer.start()
+
+    return observer
+
+
+def wait_for_download(folder, match, since=None, timeout=None, poll_interval=1,
+                      settle_time=0.5, use_events=True):
+    """
+    Wait for a finished download in folder and return its path.
+
+    args:
+    - match: function called with a file name, returning True for the file
+    being waited on
+    - since: snapshot of the folder taken before the download started. Files
+    that have not changed since then are ignored
+    - timeout: raise TimeoutError after this many seconds
+    - poll_interval: seconds between checks when polling
+    - settle_time: how long a file's size has to stay the same before it
+    counts as finished
+    - use_events: watch for file system events instead of polling, if
+    watchdog is installed
+
+    A file is only returned once no partial download (.crdownload, .part or
+    .tmp) remains for it.
+    """
+
+    since = since or {}
+    deadline = None if timeout is None else time.time() + timeout
+
+    event = threading.Event()
+    observer = _start_observer(folder, event) if use_events else None
+
+    # name -> (size, mtime, time it was first seen with that size and mtime)
+    candidates = {}
+
+    try:
+        while True:
+            event.clear()
+            now = time.time()
+            files = snapshot(folder)
+
+            for name, state in files.items():
+                if is_partial(name) or not match(name) or since.get(name) == state:
+                    continue
+
+                if any(name + suffix in files for suffix in partial_suffixes):
+                    continue
+
+                if name not in candidates or candidates[name][:2] != state:
+                    candidates[name] = state + (now,)
+
+                if now - candidates[name][2] >= settle_time:
+                    return os.path.join(folder, name)
+
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"No finished download in {folder} after {timeout}s")
+
+            if observer is None or candidates:
+                wait = settle_time if candidates else poll_interval
+            else:
+                wait = None
+
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+
+            event.wait(wait)
+
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
@@ -0,0 +1,137 @@
+# writers.py
+"""
+Backends for writing a DataFrame into a sheet of an Excel workbook.
+
+- xlwings: writes through a running Excel instance (Windows/Mac only)
+- openpyxl: writes into a new or existing workbook without Excel. New
+  workbooks are streamed in write-only mode; macros in existing .xlsm
+  workbooks are kept
+- xlsxwriter: creates a new workbook in constant-memory mode, optionally
+  copying the macros of an .xlsm template
+
+Every backend writes the index (named "Index") followed by the columns, the
+same layout xlwings produces.
+"""
+
+import io
+import os
+import re
+import zipfile
+
+
+def cell_position(cellref):
+    """Convert a cell reference such as "$B$3" to a 1-based (row, column) pair"""
+
+    match = re.fullmatch(r"\$?([A-Za-z]+)\$?(\d+)", cellref)
+
+    if match is None:
+        raise ValueError(f"Invalid cell reference: '{cellref}'")
+
+    letters, row = match.groups()
+
+    column = 0
+    for letter in letters.upper():
+        column = column * 26 + ord(letter) - ord('A') + 1
+
+    return int(row), column
+
+
+def frame_rows(df, chunk_size=10000):
+    """Yield the header and then every row of df, index first, converting chunk_size rows at a time"""
+
+    yield [df.index.name] + list(df.columns)
+
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+
+        for index, row in zip(chunk.index, chunk.itertuples(index=False, name=None)):
+            yield [index] + list(row)
+
+
+def write_with_xlwings(df, book_path, sheet, cellref="$A$1", clear=True):
+    import xlwings as xw
+
+    book = xw.Book(book_path)
+    sht = book.sheets(sheet)
+    if clear:
+        sht.clear_contents()
+
+    # rnge = sht.range(cellref)
+    # rnge.offset(1, 0).value = df.values
+    # rnge.values = list(df.columns)
+    sht.range(cellref).value = df
+
+
+def write_with_openpyxl(df, book_path, sheet, cellref="$A$1", clear=True, chunk_size=10000):
+    import openpyxl
+
+    first_row, first_column = cell_position(cellref)
+    rows = frame_rows(df, chunk_size)
+
+    if not os.path.isfile(book_path):
+        # Write-only workbooks stream rows to disk instead of keeping them in memory
+        book = openpyxl.Workbook(write_only=True)
+        sht = book.create_sheet(sheet)
+
+        for _ in range(first_row - 1):
+            sht.append([])
+
+        padding = [None] * (first_column - 1)
+        for row in rows:
+            sht.append(padding + row)
+
+        book.save(book_path)
+        return
+
+    book = openpyxl.load_workbook(book_path, keep_vba=book_path.lower().endswith('.xlsm'))
+    sht = book[sheet] if sheet in book.sheetnames else book.create_sheet(sheet)
+
+    if clear:
+        for row in sht.iter_rows():
+            for cell in row:
+                cell.value = None
+
+    for i, row in enumerate(rows, first_row):
+        for j, value in enumerate(row, first_column):
+            sht.cell(row=i, column=j, value=value)
+
+    book.save(book_path)
+
+
+def write_with_xlsxwriter(df, book_path, sheet, cellref="$A$1", clear=True, chunk_size=10000,
+                          template=None):
+    import xlsxwriter
+
+    if os.path.isfile(book_path):
+        raise ValueError(f"{book_path} already exists. xlsxwriter can only create new workbooks, "
+                         "use engine='openpyxl' to write into an existing one")
+
+    first_row, first_column = cell_position(cellref)
+
+    book = xlsxwriter.Workbook(book_path, {'constant_memory': True,
+                                           'default_date_format': 'yyyy-mm-dd'})
+
+    try:
+        if template is not None and template.lower().endswith('.xlsm'):
+            with zipfile.ZipFile(template) as archive:
+                vba_project = io.BytesIO(archive.read('xl/vbaProject.bin'))
+            book.add_vba_project(vba_project, is_stream=True)
+
+        sht = book.add_worksheet(sheet)
+
+        # constant_memory mode requires rows to be written in order
+        for i, row in enumerate(frame_rows(df, chunk_size), first_row - 1):
+            sht.write_row(i, first_column - 1, row)
+
+    finally:
+        book.close()
+
+
+# Writers by engine name, used by write_to_spreadsheet. Other backends taking
+# the same arguments can be added here.
+writers = {
+    'xlwings': write_with_xlwings,
+    'openpyxl': write_with_openpyxl,
+    'xlsxwriter': write_with_xlsxwriter,
+}